@@ -1,8 +1,16 @@
 # app.py
 import streamlit as st
 import datetime
-import json
+import html
 import os
+import time
+from streamlit.errors import StreamlitAPIException
+from chatlog import message_cursor
+from events import conversation_topic, user_topic
+from perf import metrics
+from render_cache import FragmentCache
+from search import snippet
+from storage import open_store
 
 # Page configuration with better theme
 st.set_page_config(
@@ -12,8 +20,49 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-# Database file path
+# Database file paths: legacy full snapshot plus the append-only change log
 DB_FILE = "chat_database.json"
+LOG_FILE = "chat_database.log"
+SQLITE_FILE = "chat_database.sqlite3"
+
+# Display format of a message's "time"
+TIME_FORMAT = "%I:%M %p"
+
+# Storage backend: "json" (JSON file plus change log), "sqlite", or "sharded"
+# (users in the SQLite file, messages in shard files next to it)
+STORAGE_BACKEND = os.environ.get("CHAT_STORAGE", "json")
+
+# Days without messages after which the JSON backend moves a chat into the
+# compressed archive; CHAT_ARCHIVE_DAYS=0 keeps every chat in the hot state
+ARCHIVE_AFTER_DAYS = float(os.environ.get("CHAT_ARCHIVE_DAYS", "90"))
+
+# Number of messages shown per page of chat history
+HISTORY_PAGE_SIZE = 50
+
+# Number of hits shown per page of search results
+SEARCH_PAGE_SIZE = 10
+
+# Number of users shown per page of the "All Users" list
+USERS_PAGE_SIZE = 20
+
+# Number of usernames suggested while typing a contact to add
+SUGGESTION_LIMIT = 5
+
+# Seconds between polls for new messages in the open chat
+LIVE_UPDATE_SECONDS = 2
+
+# Seconds between refreshes of the info panel, which no write reruns directly
+INFO_REFRESH_SECONDS = 10
+
+# Seconds after which a session re-queries even without change events,
+# to pick up writes made by other processes
+RESYNC_SECONDS = 30
+
+# Users who see the performance panel, e.g. CHAT_ADMINS="alice,bob"
+ADMIN_USERS = {name.strip() for name in os.environ.get("CHAT_ADMINS", "").split(",") if name.strip()}
+
+# File the performance panel appends metric snapshots to
+PERF_DUMP_FILE = "perf_metrics.jsonl"
 
 # Custom CSS for better UI colors with bold black text
 st.markdown("""
@@ -85,6 +134,9 @@ st.markdown("""
         margin: 10px 0;
         box-shadow: 0 2px 4px rgba(0,0,0,0.1);
     }
+    .search-hit {
+        outline: 3px solid #f5c518;
+    }
     .user-list {
         font-weight: bold;
         color: #000000;
@@ -99,7 +151,7 @@ st.markdown("""
 def get_current_time():
     """Get current local time in proper format"""
     now = datetime.datetime.now()
-    return now.strftime("%I:%M %p")
+    return now.strftime(TIME_FORMAT)
 
 def get_current_datetime():
     """Get current date and time"""
@@ -115,58 +167,62 @@ def get_current_date_display():
     now = datetime.datetime.now()
     return now.strftime("%B %d, %Y")
 
-def load_database():
-    """Load the shared database from file"""
-    try:
-        if os.path.exists(DB_FILE):
-            with open(DB_FILE, 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        st.error(f"Error loading database: {e}")
-    
-    # Return empty database structure
-    return {
-        "users": {},
-        "messages": [],
-        "contacts": {}
-    }
+@st.cache_resource
+def get_store():
+    """Storage engine shared by all sessions"""
+    return open_store(
+        STORAGE_BACKEND, "receiver", DB_FILE, LOG_FILE, SQLITE_FILE,
+        time_format=TIME_FORMAT, archive_after_days=ARCHIVE_AFTER_DAYS
+    )
 
-def save_database(data):
-    """Save the shared database to file"""
+def save_to_database(write, *args):
+    """Run a store write, reporting any failure in the UI"""
     try:
-        with open(DB_FILE, 'w') as f:
-            json.dump(data, f)
+        with metrics.span("store.write"):
+            write(*args)
         return True
     except Exception as e:
         st.error(f"Error saving database: {e}")
         return False
 
+def rerun_fragment():
+    """Rerun only the running fragment; during a full page run, rerun the page"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
 def initialize_session():
     """Initialize user session"""
     if 'current_user' not in st.session_state:
         st.session_state.current_user = None
         st.session_state.current_contact = None
+    if 'history_cursors' not in st.session_state:
+        # Stack of (timestamp, id) cursors, one per "load older" step
+        st.session_state.history_cursors = []
+    if 'users_cursors' not in st.session_state:
+        # Filter prefix and stack of "last name shown" cursors for the "All Users" list
+        st.session_state.users_filter = ""
+        st.session_state.users_cursors = []
+    if 'search_pages' not in st.session_state:
+        # Query and stack of message id cursors per search box
+        st.session_state.search_pages = {}
+        # Message opened from a search result, highlighted in its chat
+        st.session_state.highlight_id = None
 
-def login_section():
+def login_section(store):
     """User login/registration"""
     st.sidebar.markdown("<div class='info-card'>", unsafe_allow_html=True)
     st.sidebar.header("🔐 Login / Register")
     
-    # Load current database
-    db = load_database()
-    
     tab1, tab2 = st.sidebar.tabs(["🚪 Login", "📝 Register"])
     
     with tab1:
         username = st.text_input("Username", key="login_username").strip()
         if st.button("Login", key="login_btn", use_container_width=True):
             if username:
-                if username in db['users']:
+                if store.get_user(username) is not None:
                     st.session_state.current_user = username
-                    # Initialize user contacts if not exists
-                    if username not in db['contacts']:
-                        db['contacts'][username] = []
-                        save_database(db)
                     st.rerun()
                 else:
                     st.error("User not found! Please register first.")
@@ -175,17 +231,15 @@ def login_section():
         new_username = st.text_input("Choose Username", key="register_username").strip()
         if st.button("Register", key="register_btn", use_container_width=True):
             if new_username:
-                if new_username not in db['users']:
+                if store.get_user(new_username) is None:
                     # Register new user
-                    db['users'][new_username] = {
+                    user = {
                         "created_at": get_current_datetime(),
                         "last_login": get_current_datetime()
                     }
-                    # Initialize contacts list for new user
-                    db['contacts'][new_username] = []
                     
                     # Save to database
-                    if save_database(db):
+                    if save_to_database(store.add_user, new_username, user):
                         st.session_state.current_user = new_username
                         st.success(f"🎉 Welcome {new_username}!")
                         st.rerun()
@@ -197,80 +251,220 @@ def login_section():
                 st.error("Please enter a username")
     st.sidebar.markdown("</div>", unsafe_allow_html=True)
 
-def contacts_section():
+def load_contacts(store, current_user):
+    """Return the user's contacts, re-reading them only after a change was published"""
+    cached = st.session_state.get("contacts_cache")
+    if (cached is None or cached["user"] != current_user or cached["events"].poll() or
+            time.monotonic() - cached["synced"] > RESYNC_SECONDS):
+        cached = {
+            "user": current_user,
+            "events": store.events.subscribe(user_topic(current_user)),
+            "contacts": store.get_contacts(current_user),
+            "synced": time.monotonic()
+        }
+        st.session_state.contacts_cache = cached
+    return cached["contacts"]
+
+def add_contact(store, current_user, new_contact):
+    """Add a user to the current user's contacts, reporting problems in the sidebar"""
+    if new_contact == current_user:
+        st.error("❌ You cannot add yourself!")
+    elif store.get_user(new_contact) is not None:
+        # Add to current user's contacts
+        if new_contact not in load_contacts(store, current_user):
+            if save_to_database(store.add_contact, current_user, new_contact):
+                st.success(f"✅ Added {new_contact}!")
+                rerun_fragment()
+            else:
+                st.error("❌ Failed to save contact.")
+        else:
+            st.error("❌ Already in contacts!")
+    else:
+        st.error("❌ User not found!")
+
+@st.fragment
+def contacts_fragment(store, current_user):
+    """Sidebar contacts; adding a contact reruns only this fragment"""
+    with metrics.rerun("fragment:contacts"):
+        contacts_section(store, current_user)
+
+def contacts_section(store, current_user):
     """Manage contacts"""
-    st.sidebar.markdown("<div class='info-card'>", unsafe_allow_html=True)
-    st.sidebar.header("👥 Contacts")
-    
-    current_user = st.session_state.current_user
-    db = load_database()
+    st.markdown("<div class='info-card'>", unsafe_allow_html=True)
+    st.header("👥 Contacts")
     
     # Add contact section
-    st.sidebar.subheader("Add New Contact")
-    new_contact = st.sidebar.text_input("Enter username:").strip()
+    st.subheader("Add New Contact")
+    new_contact = st.text_input("Enter username:").strip()
     
-    if st.sidebar.button("➕ Add Contact", use_container_width=True, type="primary"):
+    if st.button("➕ Add Contact", use_container_width=True, type="primary"):
         if new_contact:
-            if new_contact == current_user:
-                st.sidebar.error("❌ You cannot add yourself!")
-            elif new_contact in db['users']:
-                # Add to current user's contacts
-                if new_contact not in db['contacts'][current_user]:
-                    db['contacts'][current_user].append(new_contact)
-                    if save_database(db):
-                        st.sidebar.success(f"✅ Added {new_contact}!")
-                        st.rerun()
-                    else:
-                        st.sidebar.error("❌ Failed to save contact.")
-                else:
-                    st.sidebar.error("❌ Already in contacts!")
-            else:
-                st.sidebar.error("❌ User not found!")
+            add_contact(store, current_user, new_contact)
+    
+    if new_contact:
+        # Autocomplete from the sorted user directory; only one short page is read
+        known = set(load_contacts(store, current_user))
+        suggestions = [
+            name for name in store.find_users(new_contact, limit=SUGGESTION_LIMIT)
+            if name != current_user and name not in known
+        ]
+        for name in suggestions:
+            if st.button(f"➕ {name}", key=f"suggest_{name}", use_container_width=True):
+                add_contact(store, current_user, name)
     
-    st.sidebar.markdown("---")
+    st.markdown("---")
     
     # Display contacts
-    st.sidebar.subheader("Your Contacts")
-    user_contacts = db['contacts'].get(current_user, [])
+    st.subheader("Your Contacts")
+    user_contacts = load_contacts(store, current_user)
     
     if not user_contacts:
-        st.sidebar.info("No contacts yet. Add someone to chat!")
+        st.info("No contacts yet. Add someone to chat!")
     else:
         for contact in user_contacts:
-            if st.sidebar.button(
+            if st.button(
                 f"💬 {contact}", 
                 key=f"chat_{contact}",
                 use_container_width=True
             ):
                 st.session_state.current_contact = contact
+                st.session_state.history_cursors = []
+                st.session_state.highlight_id = None
+                # Opening another chat changes the chat pane too
                 st.rerun()
-    st.sidebar.markdown("</div>", unsafe_allow_html=True)
+    st.markdown("</div>", unsafe_allow_html=True)
+
+def open_search_hit(message, contact):
+    """Open the chat holding a search hit at the page ending with it"""
+    st.session_state.current_contact = contact
+    timestamp, message_id = message_cursor(message)
+    # Cursors exclude the message they name, so point just past the hit
+    st.session_state.history_cursors = [(timestamp, message_id + 1)]
+    st.session_state.highlight_id = message["id"]
 
-def display_message(message):
-    """Display a chat message with bold black text"""
-    is_current_user = message["sender"] == st.session_state.current_user
+def show_search_results(store, current_user, query, contact, key):
+    """Show one page of search hits, newest first; clicking a hit opens it in its chat"""
+    search = st.session_state.search_pages.get(key)
+    if search is None or search["query"] != query or search["contact"] != contact:
+        # A new query starts again from the newest hits
+        search = {"query": query, "contact": contact, "cursors": []}
+        st.session_state.search_pages[key] = search
+    cursors = search["cursors"]
     
-    if message["type"] == "text":
-        if is_current_user:
-            st.markdown(f"""
-            <div class='user-message'>
-                <div class='message-sender'>You</div>
-                <div class='message-text'>{message["content"]}</div>
-                <div class='message-time'>{message["time"]}</div>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class='contact-message'>
-                <div class='message-sender'>{message["sender"]}</div>
-                <div class='message-text'>{message["content"]}</div>
-                <div class='message-time'>{message["time"]}</div>
-            </div>
-            """, unsafe_allow_html=True)
-
-def chat_section():
+    # One extra hit is fetched to know whether older results exist
+    hits = store.search_messages(
+        current_user, query, contact=contact,
+        limit=SEARCH_PAGE_SIZE + 1,
+        before=cursors[-1] if cursors else None
+    )
+    page = hits[:SEARCH_PAGE_SIZE]
+    if not page:
+        st.info("No matching messages.")
+        return
+    
+    for hit in page:
+        peer = hit["receiver"] if hit["sender"] == current_user else hit["sender"]
+        label = f"{peer} · {hit['time']}: {snippet(hit['content'], query)}"
+        if st.button(label, key=f"search_{key}_{hit['id']}", use_container_width=True):
+            open_search_hit(hit, peer)
+            # A hit in the open chat only moves the chat pane; any other opens a new chat
+            if contact:
+                rerun_fragment()
+            else:
+                st.rerun()
+    
+    col1, col2 = st.columns(2)
+    if cursors and col1.button("⬅️ Newer", key=f"search_{key}_newer", use_container_width=True):
+        cursors.pop()
+        rerun_fragment()
+    if len(hits) > SEARCH_PAGE_SIZE and col2.button("Older ➡️", key=f"search_{key}_older", use_container_width=True):
+        cursors.append(page[-1]["id"])
+        rerun_fragment()
+
+@st.fragment
+def search_fragment(store, current_user):
+    """Sidebar search; paging through hits reruns only this fragment"""
+    with metrics.rerun("fragment:search"):
+        search_section(store, current_user)
+
+def search_section(store, current_user):
+    """Search across all of the user's chats"""
+    st.markdown("<div class='info-card'>", unsafe_allow_html=True)
+    st.header("🔎 Search Messages")
+    
+    query = st.text_input("Search all chats:", key="global_search").strip()
+    if query:
+        show_search_results(store, current_user, query, None, "global")
+    st.markdown("</div>", unsafe_allow_html=True)
+
+@st.cache_resource
+def get_render_cache():
+    """Rendered message HTML shared by all sessions"""
+    return FragmentCache()
+
+def render_message(message, is_current_user, highlighted=False):
+    """Build the escaped HTML for one chat message with bold black text"""
+    css_class = "user-message" if is_current_user else "contact-message"
+    if highlighted:
+        css_class += " search-hit"
+    sender = "You" if is_current_user else html.escape(message["sender"])
+    content = html.escape(message["content"]).replace("\n", "<br>")
+    return (
+        f"<div class='{css_class}'>"
+        f"<div class='message-sender'>{sender}</div>"
+        f"<div class='message-text'>{content}</div>"
+        f"<div class='message-time'>{html.escape(message['time'])}</div>"
+        "</div>"
+    )
+
+@metrics.timed("render.display_messages")
+def display_messages(messages):
+    """Display a page of chat messages as a single HTML block"""
+    cache = get_render_cache()
+    fragments = []
+    for message in messages:
+        if message["type"] != "text":
+            continue
+        is_current_user = message["sender"] == st.session_state.current_user
+        highlighted = message.get("id") == st.session_state.highlight_id
+        fragments.append(cache.get(
+            (message.get("id"), message["timestamp"], is_current_user, highlighted),
+            (message["sender"], message["content"], message["time"]),
+            render_message, message, is_current_user, highlighted
+        ))
+    metrics.count("render.messages", len(fragments))
+    if fragments:
+        st.markdown("".join(fragments), unsafe_allow_html=True)
+
+@st.fragment(run_every=LIVE_UPDATE_SECONDS)
+def live_messages(store, current_user, current_contact):
+    """Show messages that arrive while the chat is open, fetching only the new ones"""
+    with metrics.rerun("fragment:live_messages"):
+        poll_live_messages(store, current_user, current_contact)
+
+def poll_live_messages(store, current_user, current_contact):
+    """Fetch and display the live tail of the open chat"""
+    new_messages = []
+    # Query the store only when this conversation changed, or now and then for other processes
+    if st.session_state.chat_events.poll() or time.monotonic() - st.session_state.chat_synced > RESYNC_SECONDS:
+        st.session_state.chat_synced = time.monotonic()
+        new_messages = store.get_messages_since(current_user, current_contact, st.session_state.live_cursor)
+    if new_messages:
+        st.session_state.live_cursor = new_messages[-1]["id"]
+        st.session_state.live_messages.extend(new_messages)
+        # Keep the live tail bounded like the history window
+        del st.session_state.live_messages[:-HISTORY_PAGE_SIZE]
+    display_messages(st.session_state.live_messages)
+
+@st.fragment
+def chat_fragment(store, current_user, current_contact):
+    """Chat pane; sending and paging rerun only this fragment"""
+    with metrics.rerun("fragment:chat"):
+        chat_section(store, current_user, current_contact)
+
+def chat_section(store, current_user, current_contact):
     """Main chat interface"""
-    if not st.session_state.current_contact:
+    if not current_contact:
         col1, col2, col3 = st.columns([1, 2, 1])
         with col2:
             st.markdown("<div class='info-card' style='text-align: center;'>", unsafe_allow_html=True)
@@ -278,32 +472,57 @@ def chat_section():
             st.markdown("</div>", unsafe_allow_html=True)
         return
     
-    db = load_database()
-    
     # Chat header with current time
     current_time = get_current_time()
     st.markdown(f"""
     <div class='chat-header'>
-        <h3>💬 Chat with {st.session_state.current_contact}</h3>
+        <h3>💬 Chat with {current_contact}</h3>
         <p>Last seen: {current_time}</p>
     </div>
     """, unsafe_allow_html=True)
     
+    # Search within this chat
+    chat_query = st.text_input(
+        "🔎 Search this chat",
+        key=f"chat_search_{current_contact}"
+    ).strip()
+    if chat_query:
+        show_search_results(store, current_user, chat_query, current_contact, "chat")
+    
     # Display messages
     chat_container = st.container()
     with chat_container:
-        # Get messages between current user and contact
-        chat_messages = [
-            msg for msg in db['messages']
-            if (msg["sender"] == st.session_state.current_user and msg["receiver"] == st.session_state.current_contact) or
-               (msg["sender"] == st.session_state.current_contact and msg["receiver"] == st.session_state.current_user)
-        ]
+        # Get one page of messages between current user and contact, already sorted by timestamp.
+        # One extra message is fetched to know whether older history exists.
+        cursors = st.session_state.history_cursors
+        # Subscribe before reading so no write between the two is missed
+        st.session_state.chat_events = store.events.subscribe(conversation_topic(current_user, current_contact))
+        page = store.get_conversation(
+            current_user,
+            current_contact,
+            limit=HISTORY_PAGE_SIZE + 1,
+            before=cursors[-1] if cursors else None
+        )
+        chat_messages = page[-HISTORY_PAGE_SIZE:]
         
-        # Sort by timestamp
-        chat_messages.sort(key=lambda x: x.get("timestamp", ""))
+        if len(page) > HISTORY_PAGE_SIZE:
+            if st.button("⬆️ Load older messages", key="history_older", use_container_width=True):
+                cursors.append(message_cursor(chat_messages[0]))
+                rerun_fragment()
         
-        for message in chat_messages:
-            display_message(message)
+        display_messages(chat_messages)
+        
+        if cursors:
+            if st.button("⬇️ Show newer messages", key="history_newer", use_container_width=True):
+                cursors.pop()
+                st.session_state.highlight_id = None
+                rerun_fragment()
+        else:
+            # On the latest page, poll for anything stored after it instead of rerunning the page
+            st.session_state.live_cursor = max((msg["id"] for msg in chat_messages), default=0)
+            st.session_state.live_messages = []
+            st.session_state.chat_synced = time.monotonic()
+            live_messages(store, current_user, current_contact)
         
         if not chat_messages:
             st.markdown("<div class='info-card' style='text-align: center;'>", unsafe_allow_html=True)
@@ -313,48 +532,90 @@ def chat_section():
     st.markdown("---")
     
     # Text input only (no image upload)
-    text_input = st.chat_input(f"💬 Type a message to {st.session_state.current_contact}...")
+    text_input = st.chat_input(f"💬 Type a message to {current_contact}...")
     if text_input:
-        db = load_database()  # Reload to get latest messages
         new_message = {
             "type": "text",
-            "sender": st.session_state.current_user,
-            "receiver": st.session_state.current_contact,
+            "sender": current_user,
+            "receiver": current_contact,
             "content": text_input,
             "time": get_current_time(),  # Current time when message is sent
             "timestamp": get_current_timestamp()
         }
-        db['messages'].append(new_message)
-        if save_database(db):
-            st.rerun()
+        if save_to_database(store.add_message, new_message):
+            # Jump back to the latest page so the new message is visible
+            st.session_state.history_cursors = []
+            rerun_fragment()
         else:
             st.error("Failed to send message")
 
-def info_section():
+@st.fragment(run_every=INFO_REFRESH_SECONDS)
+def info_fragment(store, current_user):
+    """Counts and user list; pages and refreshes on its own without rerunning the chat"""
+    with metrics.rerun("fragment:info"):
+        info_section(store, current_user)
+
+def info_section(store, current_user):
     """App information section"""
-    st.sidebar.markdown("<div class='info-card'>", unsafe_allow_html=True)
-    st.sidebar.header("📊 App Info")
-    
-    db = load_database()
+    st.markdown("<div class='info-card'>", unsafe_allow_html=True)
+    st.header("📊 App Info")
     
-    st.markdown(f'<div class="app-info-text">👤 Total Users: {len(db["users"])}</div>', unsafe_allow_html=True)
-    st.markdown(f'<div class="app-info-text">💬 Your Contacts: {len(db["contacts"].get(st.session_state.current_user, []))}</div>', unsafe_allow_html=True)
-    st.markdown(f'<div class="app-info-text">📨 Total Messages: {len(db["messages"])}</div>', unsafe_allow_html=True)
+    st.markdown(f'<div class="app-info-text">👤 Total Users: {store.user_count()}</div>', unsafe_allow_html=True)
+    st.markdown(f'<div class="app-info-text">💬 Your Contacts: {len(load_contacts(store, current_user))}</div>', unsafe_allow_html=True)
+    st.markdown(f'<div class="app-info-text">📨 Total Messages: {store.message_count()}</div>', unsafe_allow_html=True)
     st.markdown(f'<div class="app-info-text">🕐 Current Time: {get_current_time()}</div>', unsafe_allow_html=True)
     st.markdown(f'<div class="app-info-text">📅 Today\'s Date: {get_current_date_display()}</div>', unsafe_allow_html=True)
     
-    # Show all registered users
+    # Show registered users one page at a time from the sorted user directory
     st.markdown("---")
     st.subheader("👥 All Users")
-    if db['users']:
-        for user in sorted(db['users'].keys()):
-            if user == st.session_state.current_user:
-                st.markdown(f'<div class="user-list">✅ {user} (You)</div>', unsafe_allow_html=True)
+    users_filter = st.text_input("Filter by name prefix:", key="users_filter_input").strip()
+    if users_filter != st.session_state.users_filter:
+        # A new filter starts again from the first page
+        st.session_state.users_filter = users_filter
+        st.session_state.users_cursors = []
+    cursors = st.session_state.users_cursors
+    
+    # One extra name is fetched to know whether another page exists
+    users = store.find_users(users_filter, limit=USERS_PAGE_SIZE + 1, after=cursors[-1] if cursors else None)
+    page = users[:USERS_PAGE_SIZE]
+    if page:
+        for user in page:
+            if user == current_user:
+                st.markdown(f'<div class="user-list">✅ {html.escape(user)} (You)</div>', unsafe_allow_html=True)
             else:
-                st.markdown(f'<div class="user-list">👤 {user}</div>', unsafe_allow_html=True)
+                st.markdown(f'<div class="user-list">👤 {html.escape(user)}</div>', unsafe_allow_html=True)
+    elif users_filter:
+        st.markdown('<div class="user-list">No matching users</div>', unsafe_allow_html=True)
     else:
         st.markdown('<div class="user-list">No users registered yet</div>', unsafe_allow_html=True)
-    st.sidebar.markdown("</div>", unsafe_allow_html=True)
+    
+    col1, col2 = st.columns(2)
+    if cursors and col1.button("⬅️ Previous", key="users_previous", use_container_width=True):
+        cursors.pop()
+        rerun_fragment()
+    if len(users) > USERS_PAGE_SIZE and col2.button("Next ➡️", key="users_next", use_container_width=True):
+        cursors.append(page[-1])
+        rerun_fragment()
+    st.markdown("</div>", unsafe_allow_html=True)
+
+def perf_panel():
+    """Admin-only panel with hot-path latency percentiles and counters"""
+    with st.sidebar.expander("⏱️ Performance"):
+        report = metrics.report()
+        st.caption("Spans in ms; `rerun:<counter>` rows are per-rerun totals")
+        st.dataframe(report["histograms"], hide_index=True, use_container_width=True)
+        st.dataframe(report["counters"], hide_index=True, use_container_width=True)
+        col1, col2 = st.columns(2)
+        if col1.button("💾 Dump", key="perf_dump", use_container_width=True):
+            try:
+                metrics.dump(PERF_DUMP_FILE)
+                st.success(f"Saved to {PERF_DUMP_FILE}")
+            except Exception as e:
+                st.error(f"Error saving metrics: {e}")
+        if col2.button("🔄 Reset", key="perf_reset", use_container_width=True):
+            metrics.reset()
+            st.rerun()
 
 def main():
     # App title with better styling
@@ -368,9 +629,16 @@ def main():
     # Initialize user session
     initialize_session()
     
+    # Storage engine shared by every session; each section reads what it needs
+    try:
+        store = get_store()
+    except Exception as e:
+        st.error(f"Error loading database: {e}")
+        return
+    
     # Show login if not logged in
     if not st.session_state.current_user:
-        login_section()
+        login_section(store)
         st.markdown("<div class='info-card' style='text-align: center;'>", unsafe_allow_html=True)
         st.info("🔐 Please login or register to start chatting")
         st.markdown("</div>", unsafe_allow_html=True)
@@ -386,9 +654,18 @@ def main():
         st.rerun()
     st.sidebar.markdown("</div>", unsafe_allow_html=True)
     
-    contacts_section()
-    info_section()
-    chat_section()
+    # Each part reruns on its own: a send redraws only the chat pane,
+    # a contact change only the contacts in the sidebar
+    current_user = st.session_state.current_user
+    # Fragments write to the sidebar from inside its context, not through st.sidebar
+    with st.sidebar:
+        contacts_fragment(store, current_user)
+        search_fragment(store, current_user)
+        info_fragment(store, current_user)
+    if current_user in ADMIN_USERS:
+        perf_panel()
+    chat_fragment(store, current_user, st.session_state.current_contact)
 
 if __name__ == "__main__":
-    main()
+    with metrics.rerun():
+        main()
@@ -0,0 +1,195 @@
+# archive.py
+"""Compressed, immutable archive segments for cold conversations.
+
+Conversations with no recent messages are moved out of the JSON store's hot
+state into segment files. A segment holds one zlib-compressed block of
+message rows per conversation, preceded by a small index of where each
+block starts, so opening a chat decompresses only that chat's block. Blocks
+are read lazily, the first time a session pages past the hot messages of a
+chat or polls from before the archive, and the most recently used ones stay
+decompressed in memory.
+
+Each message block is followed by the conversation's search postings, the
+ids of its text messages per word, compressed separately. Searches
+intersect the postings and decompress only the blocks holding the hits.
+
+Segments are written once and never changed. A clear only adds a tombstone
+in the log, and reads skip archived messages it covers.
+"""
+import collections
+import json
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from chatlog import conversation_key
+from messages import Message
+from perf import metrics
+from search import tokenize
+
+# First bytes of every segment file, bumped whenever the layout changes
+SEGMENT_MAGIC = b"CHATSEG2\n"
+
+# Length prefix of the segment index
+INDEX_HEADER = struct.Struct(">Q")
+
+# zlib level for archived blocks; they are written once and read rarely
+COMPRESSION_LEVEL = 9
+
+# Decompressed conversations kept in memory per archive
+CACHE_CONVERSATIONS = 64
+
+# Conversations whose search postings are kept in memory per archive; a
+# search across all chats reads the postings of every archived chat of the user
+CACHE_POSTINGS = 4096
+
+
+def compress_json(value):
+    return zlib.compress(json.dumps(value, separators=(",", ":")).encode("utf-8"), COMPRESSION_LEVEL)
+
+
+def message_postings(messages):
+    """Return ``{word: [id, ...]}`` for the text messages, ids in increasing order"""
+    postings = {}
+    for message in sorted(messages, key=lambda message: message.id):
+        if message.type == "text":
+            for word in tokenize(message.content):
+                postings.setdefault(word, []).append(message.id)
+    return postings
+
+
+def write_segment(path, conversations):
+    """Atomically write a segment holding ``{(user_a, user_b): [Message, ...]}``.
+
+    Returns the number of bytes written.
+    """
+    blocks = []
+    index = []
+    offset = 0
+    for (user_a, user_b), messages in conversations.items():
+        block = compress_json([message.to_row() for message in messages])
+        postings = compress_json(message_postings(messages))
+        index.append([user_a, user_b, offset, len(block), len(messages), len(postings)])
+        blocks.extend((block, postings))
+        offset += len(block) + len(postings)
+    encoded_index = json.dumps(index, separators=(",", ":")).encode("utf-8")
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(SEGMENT_MAGIC)
+            f.write(INDEX_HEADER.pack(len(encoded_index)))
+            f.write(encoded_index)
+            for block in blocks:
+                f.write(block)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    size = len(SEGMENT_MAGIC) + INDEX_HEADER.size + len(encoded_index) + offset
+    metrics.count("archive.bytes_written", size)
+    return size
+
+
+class Segment:
+    """Read access to one segment file; the index is read on first use"""
+
+    def __init__(self, path):
+        self.path = path
+        self.index = None
+        self.data_offset = 0
+
+    def _load_index(self):
+        with open(self.path, "rb") as f:
+            if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+                raise ValueError(f"Not an archive segment: {self.path}")
+            (length,) = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            entries = json.loads(f.read(length))
+        self.data_offset = len(SEGMENT_MAGIC) + INDEX_HEADER.size + length
+        self.index = {
+            conversation_key(user_a, user_b): (offset, size, count, postings_size)
+            for user_a, user_b, offset, size, count, postings_size in entries
+        }
+
+    def _read_block(self, offset, size):
+        with metrics.span("archive.read"), open(self.path, "rb") as f:
+            f.seek(self.data_offset + offset)
+            value = json.loads(zlib.decompress(f.read(size)))
+        metrics.count("archive.bytes_read", size)
+        return value
+
+    def read(self, key):
+        """Return the archived messages of one conversation in timestamp order"""
+        if self.index is None:
+            self._load_index()
+        entry = self.index.get(key)
+        if entry is None:
+            return []
+        offset, size, _, _ = entry
+        return [Message.from_row(row) for row in self._read_block(offset, size)]
+
+    def postings(self, key):
+        """Return one conversation's ``{word: [id, ...]}`` search postings"""
+        if self.index is None:
+            self._load_index()
+        entry = self.index.get(key)
+        if entry is None:
+            return {}
+        offset, size, _, postings_size = entry
+        return self._read_block(offset + size, postings_size)
+
+
+class Archive:
+    """Directory of segments with shared caches of decompressed conversations and postings"""
+
+    def __init__(self, directory, cache_size=CACHE_CONVERSATIONS, postings_cache_size=CACHE_POSTINGS):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.postings_cache = collections.OrderedDict()
+        self.postings_cache_size = postings_cache_size
+
+    def path(self, name):
+        """Return the file path of a segment"""
+        return os.path.join(self.directory, name)
+
+    def write(self, name, conversations):
+        """Write a new segment; returns its size in bytes"""
+        os.makedirs(self.directory, exist_ok=True)
+        return write_segment(self.path(name), conversations)
+
+    def _segment(self, name):
+        with self.lock:
+            segment = self.segments.get(name)
+            if segment is None:
+                segment = self.segments[name] = Segment(self.path(name))
+            return segment
+
+    def _cached(self, cache, size, name, key, load):
+        with self.lock:
+            value = cache.get((name, key))
+            if value is not None:
+                cache.move_to_end((name, key))
+                metrics.count("archive.cache_hits")
+                return value
+        # Segments never change, so a concurrent read of the same block is merely wasted work
+        value = load(key)
+        with self.lock:
+            cache[(name, key)] = value
+            while len(cache) > size:
+                cache.popitem(last=False)
+        return value
+
+    def read(self, name, key):
+        """Return a conversation's messages from one segment, decompressing it at most once while cached"""
+        return self._cached(self.cache, self.cache_size, name, key, self._segment(name).read)
+
+    def postings(self, name, key):
+        """Return a conversation's search postings from one segment, decompressing them at most once while cached"""
+        return self._cached(self.postings_cache, self.postings_cache_size, name, key, self._segment(name).postings)
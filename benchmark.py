@@ -0,0 +1,247 @@
+# benchmark.py
+"""Reproducible benchmarks for the chat storage and rendering hot paths.
+
+Generates synthetic databases in either app's schema and reports wall time
+and peak traced memory for loading the store, sending messages, reading a
+conversation, searching messages and rendering the chat page through
+Streamlit's ``AppTest``.
+
+    python benchmark.py --messages 1000 100000 --users 10 1000 --backend json sqlite
+    python benchmark.py --schema textbox --messages 1000000 --users 100000 --output bench.json
+
+The same seed always produces the same data, so runs are comparable across
+commits and backends.
+"""
+import argparse
+import base64
+import datetime
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from storage import APP_SCHEMAS, open_store
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Each app's schema plus the script rendering it
+SCHEMAS = {name: dict(config, script=f"{name}.py") for name, config in APP_SCHEMAS.items()}
+
+# Contacts given to each generated user
+CONTACTS_PER_USER = 5
+
+# Messages sent when measuring the write path
+SENDS = 100
+
+# Page size used for the windowed conversation read, as in the apps
+PAGE_SIZE = 50
+
+START_TIME = datetime.datetime(2024, 1, 1)
+
+
+def tiny_png_data_uri():
+    """A small inline PNG like the ones textbox.py used to store"""
+    from PIL import Image
+    buffered = io.BytesIO()
+    Image.new("RGB", (64, 64), (18, 140, 126)).save(buffered, format="PNG")
+    return f"data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode()}"
+
+
+def generate(schema, n_messages, n_users, seed=0, image_ratio=0.01):
+    """Return ``(users, contacts, messages, busiest_pair)`` for a synthetic database.
+
+    ``users`` is a list of ``(username, info)``, ``contacts`` a list of
+    ``(username, contact)`` and ``messages`` an iterator of message dicts in
+    ``schema``'s shape. Image messages (textbox only) carry inline data URIs.
+    """
+    rng = random.Random(seed)
+    config = SCHEMAS[schema]
+    names = [f"user{i:06d}" for i in range(n_users)]
+    created = START_TIME.isoformat()
+    users = [(name, {"created_at": created, "last_login": created}) for name in names]
+    contacts = []
+    for name in names:
+        others = rng.sample(names, min(CONTACTS_PER_USER + 1, n_users))
+        contacts.extend((name, other) for other in others if other != name)
+    # Skew traffic so some conversations are much longer than others
+    weights = [1.0 / (rank + 1) for rank in range(len(contacts))]
+    busiest_pair = contacts[0]
+    image = tiny_png_data_uri() if schema == "textbox" and image_ratio else None
+
+    def messages():
+        moment = START_TIME
+        for index, (user_a, user_b) in enumerate(rng.choices(contacts, weights, k=n_messages)):
+            sender, peer = (user_a, user_b) if rng.random() < 0.5 else (user_b, user_a)
+            moment += datetime.timedelta(seconds=rng.randint(1, 120))
+            is_image = image is not None and rng.random() < image_ratio
+            yield {
+                "type": "image" if is_image else "text",
+                "sender": sender,
+                config["peer_key"]: peer,
+                "content": image if is_image else f"message {index} " + "lorem ipsum " * rng.randint(1, 8),
+                "time": moment.strftime(config["time_format"]),
+                "timestamp": moment.isoformat()
+            }
+
+    return users, contacts, messages(), busiest_pair
+
+
+def write_json_database(path, schema, users, contacts, messages):
+    """Write a database file in the schema's original JSON layout, streaming the messages"""
+    if schema == "app":
+        head = {"users": dict(users), "contacts": {}}
+        for username, contact in contacts:
+            head["contacts"].setdefault(username, []).append(contact)
+    else:
+        head = {"users": {username: dict(info, contacts=[]) for username, info in users}}
+        for username, contact in contacts:
+            head["users"][username]["contacts"].append(contact)
+    with open(path, "w") as f:
+        f.write(json.dumps(head)[:-1] + ', "messages": [')
+        for index, message in enumerate(messages):
+            if index:
+                f.write(", ")
+            f.write(json.dumps(message))
+        f.write("]}")
+
+
+def measure(fn, trace_memory=True):
+    """Return ``(seconds, peak_bytes)`` for ``fn``; memory comes from a second, traced run"""
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak
+
+
+def open_benchmark_store(schema, backend):
+    config = SCHEMAS[schema]
+    return open_store(
+        backend, config["peer_key"], config["json"], config["log"], config["sqlite"],
+        time_format=config["time_format"]
+    )
+
+
+def render_chat(schema, backend, user, contact):
+    """Run the app once with a chat open, the way a browser rerun would"""
+    from streamlit.testing.v1 import AppTest
+    import streamlit as st
+
+    # Stores are cached per process; start each render from a cold cache
+    st.cache_resource.clear()
+    os.environ["CHAT_STORAGE"] = backend
+    at = AppTest.from_file(os.path.join(APP_DIR, SCHEMAS[schema]["script"]), default_timeout=600)
+    at.session_state.current_user = user
+    at.session_state.current_contact = contact
+    if schema == "textbox":
+        # textbox.py fills the rest of its session state on first run
+        at.run()
+        at.session_state.current_user = user
+        at.session_state.current_contact = contact
+    at.run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+
+
+def run_case(schema, backend, n_messages, n_users, args):
+    """Benchmark one schema/backend/size combination; return a list of result rows"""
+    users, contacts, messages, (user, contact) = generate(schema, n_messages, n_users, args.seed, args.image_ratio)
+    config = SCHEMAS[schema]
+    rows = []
+
+    def record(operation, seconds, peak, count=1):
+        rows.append({
+            "schema": schema, "backend": backend, "users": n_users, "messages": n_messages,
+            "operation": operation, "seconds": seconds / count,
+            "peak_mb": None if peak is None else peak / 2 ** 20
+        })
+
+    if backend == "json":
+        start = time.perf_counter()
+        write_json_database(config["json"], schema, users, contacts, messages)
+        record("setup (write JSON)", time.perf_counter() - start, None)
+        # Cold starts read the snapshot written here, as they would after the first start
+        start = time.perf_counter()
+        open_benchmark_store(schema, backend).checkpoint()
+        record("setup (snapshot)", time.perf_counter() - start, None)
+    else:
+        start = time.perf_counter()
+        open_benchmark_store(schema, backend).import_data(users, contacts, messages)
+        record("setup (import)", time.perf_counter() - start, None)
+
+    record("load store", *measure(lambda: open_benchmark_store(schema, backend).message_count(), args.memory))
+
+    store = open_benchmark_store(schema, backend)
+    store.message_count()
+    moment = START_TIME + datetime.timedelta(days=3650)
+
+    def send():
+        for _ in range(SENDS):
+            store.add_message({
+                "type": "text", "sender": user, config["peer_key"]: contact, "content": "benchmark",
+                "time": moment.strftime(config["time_format"]), "timestamp": moment.isoformat()
+            })
+
+    record("send message", *measure(send, args.memory), count=SENDS)
+    record("read conversation", *measure(lambda: store.get_conversation(user, contact), args.memory))
+    record("read latest page", *measure(lambda: store.get_conversation(user, contact, limit=PAGE_SIZE), args.memory))
+    record("search (first page)", *measure(lambda: store.search_messages(user, "lorem ipsum", limit=PAGE_SIZE), args.memory))
+    if args.render:
+        record("render chat (AppTest)", *measure(lambda: render_chat(schema, backend, user, contact), args.memory))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--schema", nargs="+", choices=sorted(SCHEMAS), default=["app", "textbox"])
+    parser.add_argument("--backend", nargs="+", choices=["json", "sqlite", "sharded"], default=["json", "sqlite"])
+    parser.add_argument("--messages", nargs="+", type=int, default=[1000, 10000])
+    parser.add_argument("--users", nargs="+", type=int, default=[10, 100])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--image-ratio", type=float, default=0.01, help="share of image messages (textbox schema)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="skip the traced peak-memory runs")
+    parser.add_argument("--no-render", dest="render", action="store_false", help="skip the AppTest render runs")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'schema':8} {'backend':7} {'users':>7} {'messages':>9}  {'operation':24} {'ms':>10} {'peak MB':>8}")
+    for schema in args.schema:
+        for backend in args.backend:
+            for n_users in args.users:
+                for n_messages in args.messages:
+                    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+                    cwd = os.getcwd()
+                    os.chdir(workdir)
+                    try:
+                        rows = run_case(schema, backend, n_messages, n_users, args)
+                    finally:
+                        os.chdir(cwd)
+                        shutil.rmtree(workdir, ignore_errors=True)
+                    for row in rows:
+                        peak = "" if row["peak_mb"] is None else f"{row['peak_mb']:.1f}"
+                        print(
+                            f"{row['schema']:8} {row['backend']:7} {row['users']:>7} {row['messages']:>9}  "
+                            f"{row['operation']:24} {row['seconds'] * 1000:>10.2f} {peak:>8}"
+                        )
+                    results.extend(rows)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
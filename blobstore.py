@@ -0,0 +1,68 @@
+# blobstore.py
+"""Content-addressed storage for image bytes.
+
+Each image is written once under the SHA-256 of its bytes, so uploading the
+same picture again costs nothing and messages only carry the short blob id.
+Blobs live under Streamlit's ``static/`` folder and are served by URL
+(``server.enableStaticServing``) instead of being inlined as data URIs.
+"""
+import base64
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+
+# Blob ids are the hex digest plus a file extension, which static serving
+# needs to pick the right Content-Type
+BLOB_ID = re.compile(r"^[0-9a-f]{64}\.[a-z0-9]+$")
+
+# URL prefix Streamlit serves the app's static/ folder under
+STATIC_URL = "app/static"
+
+
+class BlobStore:
+    """Directory of immutable blobs named by content hash"""
+
+    def __init__(self, root, url_prefix=f"{STATIC_URL}/blobs"):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def _relative_path(self, blob_id):
+        if not BLOB_ID.match(blob_id):
+            raise ValueError(f"Invalid blob id: {blob_id!r}")
+        # Fan out over 256 subdirectories to keep directories small
+        return f"{blob_id[:2]}/{blob_id}"
+
+    def path(self, blob_id):
+        """Return the file path of a blob"""
+        return os.path.join(self.root, self._relative_path(blob_id))
+
+    def url(self, blob_id):
+        """Return the URL the blob is served under"""
+        return f"{self.url_prefix}/{self._relative_path(blob_id)}"
+
+    def put(self, data, extension):
+        """Store bytes and return their blob id; storing existing content is a no-op"""
+        blob_id = f"{hashlib.sha256(data).hexdigest()}.{extension.lower()}"
+        path = self.path(blob_id)
+        if os.path.exists(path):
+            return blob_id
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return blob_id
+
+    def put_data_uri(self, uri):
+        """Store the bytes of a base64 ``data:`` URI, as older messages inline them; return the blob id"""
+        header, _, payload = uri.partition(",")
+        mime_type = header[len("data:"):].split(";")[0]
+        extension = (mimetypes.guess_extension(mime_type) or ".bin").lstrip(".")
+        return self.put(base64.b64decode(payload), extension)
@@ -0,0 +1,218 @@
+# chatlog.py
+"""Append-only, line-delimited record log shared by app.py and textbox.py.
+
+Every change (registration, new contact, message) is written as one JSON
+line at the end of the log, so a send costs one small write no matter how
+much history exists. State is rebuilt by replaying the records in order.
+
+A binary snapshot of the replayed state can be written next to the log, so
+startup loads the snapshot and replays only the records after it.
+"""
+import bisect
+import gc
+import json
+import mmap
+import os
+import pickle
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from perf import metrics
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory file locks (Windows): appends from other processes are not serialized
+    fcntl = None
+
+
+def conversation_key(user_a, user_b):
+    """Key identifying the conversation between two users, in either direction"""
+    return (user_a, user_b) if user_a <= user_b else (user_b, user_a)
+
+
+def message_timestamp(message):
+    """Sort key used to order messages inside a conversation"""
+    return message.get("timestamp", "")
+
+
+def message_cursor(message):
+    """Keyset cursor of a message: its position in conversation order"""
+    return (message_timestamp(message), message.get("id", 0))
+
+
+def conversation_page(chat, limit=None, before=None, key=message_cursor):
+    """Return the newest ``limit`` messages of an indexed chat older than ``before``.
+
+    ``before`` is a cursor in the form ``key`` returns, ``message_cursor()``
+    by default; the result stays in timestamp order.
+    """
+    end = len(chat) if before is None else bisect.bisect_left(chat, tuple(before), key=key)
+    start = 0 if limit is None else max(0, end - limit)
+    return chat[start:end]
+
+
+def encode_record(record):
+    """Encode a record as a single newline-terminated log line"""
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def append_records(path, records, sync=False):
+    """Append several records with a single write, optionally followed by one fsync"""
+    data = b"".join(encode_record(record) for record in records)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+        if sync:
+            with metrics.span("log.fsync"):
+                os.fsync(fd)
+    finally:
+        os.close(fd)
+    metrics.count("log.bytes_written", len(data))
+
+
+def read_records(path, offset=0):
+    """Yield ``(record, end_offset)`` for each record after ``offset``, oldest first"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Torn final line from an interrupted write; ignore it
+                break
+            offset += len(line)
+            line = line.strip()
+            if line:
+                yield json.loads(line), offset
+
+
+# First bytes of every snapshot file, bumped whenever the snapshot layout changes
+SNAPSHOT_MAGIC = b"CHATSNAP7\n"
+
+
+def write_snapshot(path, snapshot):
+    """Atomically write a snapshot dict as a pickle next to the log"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(SNAPSHOT_MAGIC)
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_snapshot(path):
+    """Return the snapshot dict stored at ``path``, or None if there is no usable one"""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size <= len(SNAPSHOT_MAGIC):
+            return None
+        # Unpickle straight from the page cache instead of reading into a buffer first
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                return None
+            # Millions of new objects would otherwise trigger repeated full collections
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                with memoryview(mapped)[len(SNAPSHOT_MAGIC):] as view:
+                    return pickle.loads(view)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+
+
+def file_signature(path):
+    """Cheap identity of a file's current contents: inode, size and mtime"""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class CachedLog:
+    """Replayed log state shared by every session in the process.
+
+    ``get()`` costs a single ``stat`` while neither the log file nor the
+    in-process version counter changed. When the log only grew, just the
+    new tail is replayed; if it was replaced or truncated, the state is
+    rebuilt from ``load_snapshot()``, which returns ``(state, offset)`` or
+    None, falling back to ``load_base()`` and a full replay. Callers must
+    treat the state as read-only.
+    """
+
+    def __init__(self, path, load_base, apply, load_snapshot=None):
+        self.path = path
+        self.load_base = load_base
+        self.apply = apply
+        self.load_snapshot = load_snapshot
+        self.lock = threading.Lock()
+        self.state = None
+        self.offset = 0
+        self.signature = None
+        self.version = 0
+        self.loaded_version = None
+
+    def get(self):
+        """Return the current state, replaying only what changed"""
+        with self.lock:
+            signature = file_signature(self.path)
+            if self.state is not None and signature == self.signature and self.version == self.loaded_version:
+                return self.state
+            replaced = (
+                self.state is None or signature is None or self.signature is None or
+                signature[0] != self.signature[0] or signature[1] < self.offset
+            )
+            if replaced:
+                loaded = self.load_snapshot() if self.load_snapshot else None
+                self.state, self.offset = loaded if loaded else (self.load_base(), 0)
+            start_offset = self.offset
+            with metrics.span("log.replay"):
+                for record, self.offset in read_records(self.path, self.offset):
+                    self.apply(self.state, record)
+            metrics.count("log.bytes_read", self.offset - start_offset)
+            self.signature = signature
+            self.loaded_version = self.version
+            return self.state
+
+    def update(self, state, change):
+        """Run ``change(state)`` under the lock if ``state`` is still the current state"""
+        with self.lock:
+            if self.state is not state:
+                return False
+            change(state)
+            return True
+
+    def append_many(self, records, sync=False):
+        """Append a batch of records with one write and mark the cached state stale"""
+        append_records(self.path, records, sync)
+        with self.lock:
+            self.version += 1
+
+    @contextmanager
+    def exclusive(self):
+        """Hold an exclusive lock on the log against writers in other processes.
+
+        A writer that reads the state and then appends based on it (e.g. to
+        number messages) does both under this lock so no other process
+        appends in between.
+        """
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
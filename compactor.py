@@ -0,0 +1,58 @@
+# compactor.py
+"""Background reclamation of space left behind by tombstones.
+
+Clearing a chat only records a tombstone, so the request path never pays
+for the deleted history. A compactor thread later removes the tombstoned
+messages a bounded chunk at a time, pausing between chunks so sends and
+reads are never held up for long. The JSON store uses the same kind of
+thread to write its periodic snapshots.
+"""
+import threading
+import time
+
+from perf import metrics
+
+# Messages removed per compaction step
+COMPACTION_CHUNK = 1000
+
+# Seconds to pause between steps, leaving room for request-path writes
+COMPACTION_PAUSE = 0.05
+
+# Seconds between checks for work when nobody asked for a compaction
+IDLE_INTERVAL = 60
+
+
+class Compactor:
+    """Background thread calling ``step()`` until it reports no work left.
+
+    ``step()`` reclaims at most one chunk and returns True while more work
+    remains. ``wake()`` starts a pass right away, e.g. after a clear.
+    """
+
+    def __init__(self, step, name="compactor", pause=COMPACTION_PAUSE, idle_interval=IDLE_INTERVAL):
+        self.step = step
+        self.name = name
+        self.pause = pause
+        self.idle_interval = idle_interval
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def wake(self):
+        """Ask for a compaction pass as soon as possible"""
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.idle_interval)
+            self.wakeup.clear()
+            try:
+                while True:
+                    with metrics.span(f"{self.name}:step"):
+                        more = self.step()
+                    if not more:
+                        break
+                    time.sleep(self.pause)
+            except Exception:
+                # Steps only ever remove what is already persisted elsewhere; retry on the next pass
+                metrics.count(f"{self.name}:errors")
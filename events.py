@@ -0,0 +1,69 @@
+# events.py
+"""In-process change notifications shared by every session.
+
+Stores publish a topic whenever a write commits: the conversation and both
+users for a message, the user for a contact change, and the user directory
+for a registration. A session subscribes to the topics it is showing and
+re-queries the store only after one of them was published, so idle
+sessions cost a few dictionary lookups per poll.
+
+Writes made by other processes are not seen here; sessions still resync
+with the store from time to time to pick those up.
+"""
+import threading
+
+from chatlog import conversation_key
+
+USERS_TOPIC = ("users",)
+
+
+def conversation_topic(user_a, user_b):
+    """Topic published when a conversation gains or loses messages"""
+    return ("conversation",) + conversation_key(user_a, user_b)
+
+
+def user_topic(username):
+    """Topic published when anything about a user's chats or contacts changes"""
+    return ("user", username)
+
+
+class EventBus:
+    """Per-topic publish counters"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.versions = {}
+
+    def publish(self, *topics):
+        """Record that each topic changed"""
+        with self.lock:
+            for topic in topics:
+                self.versions[topic] = self.versions.get(topic, 0) + 1
+
+    def version(self, topic):
+        """Return how many times a topic has been published"""
+        return self.versions.get(topic, 0)
+
+    def subscribe(self, *topics):
+        """Start watching topics from their current version"""
+        return Subscription(self, topics)
+
+
+class Subscription:
+    """A session's view of a set of topics"""
+
+    def __init__(self, bus, topics):
+        self.bus = bus
+        self.topics = topics
+        self.seen = self._current()
+
+    def _current(self):
+        return tuple(self.bus.version(topic) for topic in self.topics)
+
+    def poll(self):
+        """Return True if any topic was published since the last poll"""
+        current = self._current()
+        if current == self.seen:
+            return False
+        self.seen = current
+        return True
@@ -0,0 +1,73 @@
+# imaging.py
+"""Background processing of uploaded chat images.
+
+Uploads are handed to a shared thread pool so the session never blocks on
+decoding or encoding. Each image is stored in the blob store twice: a
+full-size copy, kept byte-for-byte as uploaded when its format is safe, its
+dimensions are within bounds and it carries no metadata, and a small
+thumbnail used inline in the chat. Blobs are served without authentication,
+so images with EXIF or similar metadata (camera, GPS location) are always
+re-encoded, which keeps only the orientation, applied to the pixels.
+"""
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+# Larger images are downscaled so neither side exceeds this many pixels
+MAX_DIMENSION = 2048
+
+# Bounding box of the thumbnails shown inline in the chat
+THUMBNAIL_SIZE = (320, 320)
+
+# Formats stored unchanged when no resize is needed, with their blob extension
+SAFE_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+
+# Image.info keys holding metadata that must not be published with the image
+METADATA_KEYS = ("exif", "xmp", "XML:com.adobe.xmp", "comment")
+
+# Pillow decodes and encodes with the GIL released, so threads run in parallel
+executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="image-worker")
+
+
+def encode_image(image, image_format):
+    """Encode an image in its original format when possible, PNG otherwise"""
+    buffered = io.BytesIO()
+    if image_format == "JPEG":
+        image.convert("RGB").save(buffered, format="JPEG", quality=85, optimize=True)
+        return buffered.getvalue(), "jpg"
+    if image_format == "WEBP":
+        image.save(buffered, format="WEBP", quality=85)
+        return buffered.getvalue(), "webp"
+    image.save(buffered, format="PNG", optimize=True)
+    return buffered.getvalue(), "png"
+
+
+def has_metadata(image):
+    """Check whether an image carries EXIF, XMP, comments or PNG text chunks"""
+    return (
+        bool(image.getexif()) or any(key in image.info for key in METADATA_KEYS)
+        or bool(getattr(image, "text", None))
+    )
+
+
+def process_image(data, blobs):
+    """Store the full-size image and its thumbnail; return both blob ids"""
+    with Image.open(io.BytesIO(data)) as image:
+        image_format = image.format
+        if image_format in SAFE_FORMATS and max(image.size) <= MAX_DIMENSION and not has_metadata(image):
+            full_id = blobs.put(data, SAFE_FORMATS[image_format])
+        else:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((MAX_DIMENSION, MAX_DIMENSION))
+            full_id = blobs.put(*encode_image(image, image_format))
+        thumbnail = image.copy()
+        thumbnail.thumbnail(THUMBNAIL_SIZE)
+        thumbnail_id = blobs.put(*encode_image(thumbnail, image_format))
+    return full_id, thumbnail_id
+
+
+def submit_image(data, blobs):
+    """Queue an upload for processing; the future resolves to ``(full_id, thumbnail_id)``"""
+    return executor.submit(process_image, data, blobs)
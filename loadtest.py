@@ -0,0 +1,296 @@
+# loadtest.py
+"""Concurrent load generator for the chat storage layer.
+
+Starts worker processes that each run several simulated sessions as
+threads, all sharing one data directory the way several Streamlit workers
+would. Sessions register, add contacts and send messages through the same
+store the apps use. The run reports latency percentiles and throughput per
+operation, then reopens the store and checks that every acknowledged
+registration, contact and message is there. Sessions also race to register
+names from a small shared pool; each of those must be acknowledged to
+exactly one session, whose registration is the one stored.
+
+    python loadtest.py --backend json sqlite sharded --processes 4 --sessions 8
+    python loadtest.py --schema textbox --actions 1000 --output load.json
+
+Exits with status 1 if anything acknowledged was lost, two sends got the same id
+or a shared name was registered more than once.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from chatlog import conversation_key
+from perf import PERCENTILES, Histogram
+from storage import APP_SCHEMAS, open_store
+
+# Share of session actions per operation; the rest are sends
+CONTACT_RATIO = 0.07
+REGISTER_RATIO = 0.03
+
+# Names every session tries to register at the start, so registrations collide across sessions and processes
+SHARED_NAMES = 16
+
+OPERATIONS = ("register", "add_contact", "send")
+
+
+def session_name(process, session):
+    return f"lt-p{process}-s{session}"
+
+
+def shared_name(index):
+    return f"lt-shared-{index}"
+
+
+def open_load_store(schema, backend, workdir):
+    config = APP_SCHEMAS[schema]
+    return open_store(
+        backend, config["peer_key"],
+        os.path.join(workdir, config["json"]),
+        os.path.join(workdir, config["log"]),
+        os.path.join(workdir, config["sqlite"]),
+        time_format=config["time_format"]
+    )
+
+
+def run_session(store, schema, process, session, args, result, lock):
+    """One simulated user: register, race for the shared names, then a random mix of contacts, registrations and sends"""
+    config = APP_SCHEMAS[schema]
+    rng = random.Random(f"{args.seed}-{process}-{session}")
+    username = session_name(process, session)
+    everyone = [session_name(p, s) for p in range(args.processes) for s in range(args.sessions)]
+    contacts = []
+    extra_users = 0
+
+    def timed(operation, fn, *fn_args):
+        start = time.perf_counter()
+        try:
+            value = fn(*fn_args)
+        except Exception:
+            with lock:
+                result["errors"][operation] = result["errors"].get(operation, 0) + 1
+            return None
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            result["latency"][operation].record(elapsed)
+        return value
+
+    if timed("register", store.add_user, username, {"created_at": datetime.datetime.now().isoformat()}):
+        result["users"].append(username)
+    for index in range(SHARED_NAMES):
+        # The owner field tells whose registration was stored
+        if timed("register", store.add_user, shared_name(index), {"owner": username}):
+            result["claims"].append((shared_name(index), username))
+    for seq in range(args.actions):
+        roll = rng.random()
+        if roll < REGISTER_RATIO:
+            extra_users += 1
+            name = f"{username}-u{extra_users}"
+            if timed("register", store.add_user, name, {"created_at": datetime.datetime.now().isoformat()}):
+                result["users"].append(name)
+        elif roll < REGISTER_RATIO + CONTACT_RATIO or not contacts:
+            contact = rng.choice(everyone)
+            if contact != username and contact not in contacts:
+                # add_contact() returns False for a duplicate, which is still stored
+                if timed("add_contact", store.add_contact, username, contact) is not None:
+                    contacts.append(contact)
+                    result["contacts"].append((username, contact))
+        else:
+            peer = rng.choice(contacts)
+            now = datetime.datetime.now()
+            message = {
+                "type": "text",
+                "sender": username,
+                config["peer_key"]: peer,
+                "content": f"load {username} {seq}",
+                "time": now.strftime(config["time_format"]),
+                "timestamp": now.isoformat()
+            }
+            message_id = timed("send", store.add_message, message)
+            if message_id is not None:
+                result["acks"].append((username, peer, message["content"], message_id))
+
+
+def run_worker(schema, backend, workdir, process, args, start_barrier, results):
+    """Worker process body: run every session of this process as a thread"""
+    store = open_load_store(schema, backend, workdir)
+    lock = threading.Lock()
+    result = {
+        "latency": {operation: Histogram() for operation in OPERATIONS},
+        "errors": {}, "users": [], "contacts": [], "acks": [], "claims": []
+    }
+    threads = [
+        threading.Thread(target=run_session, args=(store, schema, process, session, args, result, lock))
+        for session in range(args.sessions)
+    ]
+    start_barrier.wait()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(result)
+
+
+def verify(store, users, contacts, acks):
+    """Return ``(lost_users, lost_contacts, lost_messages, unexpected_messages)`` after a run"""
+    lost_users = [username for username in users if store.get_user(username) is None]
+    stored_contacts = {}
+    lost_contacts = []
+    for username, contact in contacts:
+        if username not in stored_contacts:
+            stored_contacts[username] = set(store.get_contacts(username))
+        if contact not in stored_contacts[username]:
+            lost_contacts.append((username, contact))
+    sent = {}
+    for sender, peer, content, _ in acks:
+        sent.setdefault(conversation_key(sender, peer), []).append(content)
+    lost_messages = []
+    unexpected = 0
+    for (user_a, user_b), contents in sent.items():
+        stored = [message["content"] for message in store.get_conversation(user_a, user_b)]
+        lost_messages.extend(sorted(set(contents) - set(stored)))
+        # Duplicates, or messages nobody was told were stored
+        unexpected += len(stored) - len(set(stored) & set(contents))
+    return lost_users, lost_contacts, lost_messages, unexpected
+
+
+def verify_claims(store, claims):
+    """Return the shared names acknowledged to several sessions or stored for another one"""
+    owners = {}
+    for name, owner in claims:
+        owners.setdefault(name, []).append(owner)
+    return sorted(
+        name for name, claimed in owners.items()
+        if len(claimed) > 1 or (store.get_user(name) or {}).get("owner") != claimed[0]
+    )
+
+
+def run_case(schema, backend, args):
+    """Run one load test against a fresh data directory; return the result row"""
+    workdir = os.path.join(args.dir, f"{schema}-{backend}") if args.dir else tempfile.mkdtemp(prefix="chat-load-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        # Create the schema once up front instead of racing on it in every worker
+        store = open_load_store(schema, backend, workdir)
+        context = multiprocessing.get_context("spawn")
+        start_barrier = context.Barrier(args.processes + 1)
+        results = context.Queue()
+        workers = [
+            context.Process(
+                target=run_worker, args=(schema, backend, workdir, process, args, start_barrier, results)
+            )
+            for process in range(args.processes)
+        ]
+        for worker in workers:
+            worker.start()
+        start_barrier.wait()
+        start = time.perf_counter()
+        collected = [results.get() for _ in workers]
+        seconds = time.perf_counter() - start
+        for worker in workers:
+            worker.join()
+
+        latency = {operation: Histogram() for operation in OPERATIONS}
+        errors = {}
+        users, contacts, acks, claims = [], [], [], []
+        for result in collected:
+            for operation, histogram in result["latency"].items():
+                latency[operation].merge(histogram)
+            for operation, count in result["errors"].items():
+                errors[operation] = errors.get(operation, 0) + count
+            users.extend(result["users"])
+            contacts.extend(result["contacts"])
+            acks.extend(result["acks"])
+            claims.extend(result["claims"])
+
+        lost_users, lost_contacts, lost_messages, unexpected = verify(store, users, contacts, acks)
+        ids = [message_id for *_, message_id in acks]
+        return {
+            "schema": schema, "backend": backend,
+            "processes": args.processes, "sessions": args.processes * args.sessions,
+            "seconds": seconds,
+            "operations": {
+                operation: dict(
+                    {"count": histogram.count, "per_second": histogram.count / seconds},
+                    **{f"p{p}_ms": histogram.percentile(p) for p in PERCENTILES},
+                    max_ms=histogram.max
+                )
+                for operation, histogram in latency.items()
+            },
+            "errors": errors,
+            "acked_messages": len(acks),
+            "lost_users": lost_users,
+            "lost_contacts": lost_contacts,
+            "lost_messages": lost_messages,
+            "unexpected_messages": unexpected,
+            "double_registrations": verify_claims(store, claims),
+            # Ids handed back to senders that another send also received
+            "duplicate_ids": len(ids) - len(set(ids))
+        }
+    finally:
+        if not args.dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def failed(row):
+    return bool(
+        row["lost_users"] or row["lost_contacts"] or row["lost_messages"] or row["duplicate_ids"] or
+        row["double_registrations"]
+    )
+
+
+def print_row(row):
+    print(
+        f"\n{row['schema']} / {row['backend']}: {row['processes']} processes, {row['sessions']} sessions, "
+        f"{row['seconds']:.2f}s"
+    )
+    print(f"  {'operation':12} {'count':>7} {'ops/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for operation, stats in row["operations"].items():
+        print(
+            f"  {operation:12} {stats['count']:>7} {stats['per_second']:>9.0f} {stats['p50_ms']:>8.2f} "
+            f"{stats['p95_ms']:>8.2f} {stats['p99_ms']:>8.2f} {stats['max_ms']:>8.2f}"
+        )
+    if row["errors"]:
+        print(f"  errors: {row['errors']}")
+    print(
+        f"  verified {row['acked_messages']} acknowledged messages: {'FAILED' if failed(row) else 'OK'} "
+        f"(lost users {len(row['lost_users'])}, contacts {len(row['lost_contacts'])}, "
+        f"messages {len(row['lost_messages'])}; unexpected messages {row['unexpected_messages']}, "
+        f"duplicate ids {row['duplicate_ids']}, double registrations {len(row['double_registrations'])})"
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--schema", nargs="+", choices=sorted(APP_SCHEMAS), default=["app"])
+    parser.add_argument("--backend", nargs="+", choices=["json", "sqlite", "sharded"], default=["json", "sqlite"])
+    parser.add_argument("--processes", type=int, default=2, help="worker processes sharing the data directory")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions (threads) per process")
+    parser.add_argument("--actions", type=int, default=200, help="actions per session after registering")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", help="keep each run's data in a subdirectory of this one (default: temporary)")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    rows = []
+    for schema in args.schema:
+        for backend in args.backend:
+            row = run_case(schema, backend, args)
+            print_row(row)
+            rows.append(row)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 1 if any(failed(row) for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
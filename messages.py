@@ -0,0 +1,158 @@
+# messages.py
+"""Compact in-memory message records for the JSON store.
+
+Apps exchange messages as plain dicts, which repeat every key and keep the
+same instant twice: as the ISO ``timestamp`` and as the display ``time``.
+``Message`` is a slotted record instead. User names and message types are
+interned, the timestamp is an integer, and the display time is only kept
+when it cannot be derived from the timestamp. ``from_dict()`` and
+``to_dict()`` convert losslessly to and from the apps' JSON shape; rows
+are the compact form written to the log.
+"""
+import datetime
+import functools
+import sys
+
+# Timestamps are stored as microseconds since this naive instant, like the
+# naive local ISO strings the apps write
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Sort position of messages without a usable timestamp: before all others
+NO_TIMESTAMP = -1 << 62
+
+
+# Fields with a slot of their own; everything else goes into ``extra``
+SLOT_FIELDS = frozenset(("id", "type", "sender", "content", "time", "timestamp"))
+
+ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+MICROSECONDS_PER_MINUTE = 60 * 1000 * 1000
+
+# strftime directives finer than a minute; formats without them are cached per minute
+SUB_MINUTE_DIRECTIVES = ("%S", "%f", "%T", "%X", "%c", "%r", "%s")
+
+
+def parse_datetime(value):
+    """Return the naive datetime of an ISO timestamp, or None if it cannot be parsed"""
+    try:
+        moment = datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def parse_timestamp(value):
+    """Return the integer form of an ISO timestamp, or None if it cannot be parsed"""
+    moment = parse_datetime(value)
+    return None if moment is None else (moment - EPOCH) // ONE_MICROSECOND
+
+
+def to_datetime(timestamp):
+    """Return the naive datetime of an integer timestamp"""
+    return EPOCH + datetime.timedelta(microseconds=timestamp)
+
+
+@functools.lru_cache(maxsize=16384)
+def _minute_display_time(minute, time_format):
+    return to_datetime(minute * MICROSECONDS_PER_MINUTE).strftime(time_format)
+
+
+@functools.lru_cache(maxsize=None)
+def _is_per_minute(time_format):
+    return not any(directive in time_format for directive in SUB_MINUTE_DIRECTIVES)
+
+
+def display_time(timestamp, time_format):
+    """Format an integer timestamp for display, reusing the result for the whole minute"""
+    if _is_per_minute(time_format):
+        return _minute_display_time(timestamp // MICROSECONDS_PER_MINUTE, time_format)
+    return to_datetime(timestamp).strftime(time_format)
+
+
+class Message:
+    """One chat message with interned participants and an integer timestamp"""
+
+    __slots__ = ("id", "type", "sender", "peer", "content", "timestamp", "time", "extra")
+
+    def __init__(self, id, type, sender, peer, content, timestamp, time=None, extra=None):
+        # Callers intern the strings; unpickling gets them shared through the pickle memo
+        self.id = id
+        self.type = type
+        self.sender = sender
+        self.peer = peer
+        self.content = content
+        self.timestamp = timestamp
+        # Display time, only when it differs from the one derived from the timestamp
+        self.time = time
+        # Any other fields, plus the original timestamp string if it did not round-trip
+        self.extra = extra
+
+    def __reduce__(self):
+        # Pickle as a plain tuple of fields, much smaller than the default slot dict
+        return Message, self.to_row()
+
+    @classmethod
+    def from_dict(cls, data, peer_key, time_format=None):
+        """Build a record from an app-shaped message dict"""
+        extra = {key: value for key, value in data.items() if key not in SLOT_FIELDS and key != peer_key}
+        raw_timestamp = data.get("timestamp")
+        moment = parse_datetime(raw_timestamp)
+        timestamp = None
+        if moment is not None:
+            timestamp = (moment - EPOCH) // ONE_MICROSECOND
+        if moment is None or moment.isoformat() != raw_timestamp:
+            extra["timestamp"] = raw_timestamp
+        time = data.get("time")
+        if time is not None:
+            if timestamp is not None and time_format and display_time(timestamp, time_format) == time:
+                time = None
+            else:
+                time = sys.intern(time)
+        return cls(
+            data.get("id"), sys.intern(data["type"]), sys.intern(data["sender"]), sys.intern(data[peer_key]),
+            data["content"], timestamp, time, extra or None
+        )
+
+    def to_dict(self, peer_key, time_format=None):
+        """Return the message in the apps' dict shape"""
+        time = self.time
+        if time is None and self.timestamp is not None and time_format:
+            time = display_time(self.timestamp, time_format)
+        data = {
+            "id": self.id,
+            "type": self.type,
+            "sender": self.sender,
+            peer_key: self.peer,
+            "content": self.content,
+            "time": time,
+            "timestamp": None if self.timestamp is None else to_datetime(self.timestamp).isoformat()
+        }
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def to_row(self):
+        """Return the fields as a tuple, in constructor order"""
+        return (self.id, self.type, self.sender, self.peer, self.content, self.timestamp, self.time, self.extra)
+
+    @classmethod
+    def from_row(cls, row):
+        """Build a record from ``to_row()`` output, e.g. a decoded log line"""
+        message_id, message_type, sender, peer, content, timestamp, time, extra = row
+        return cls(
+            message_id, sys.intern(message_type), sys.intern(sender), sys.intern(peer),
+            content, timestamp, time and sys.intern(time), extra
+        )
+
+    def sort_key(self):
+        """Position in conversation order: timestamp, then id"""
+        return (NO_TIMESTAMP if self.timestamp is None else self.timestamp, self.id or 0)
+
+
+def cursor_key(cursor):
+    """Convert an app-side ``(timestamp, id)`` cursor to ``Message.sort_key()`` form"""
+    timestamp, message_id = cursor
+    parsed = parse_timestamp(timestamp)
+    return (NO_TIMESTAMP if parsed is None else parsed, message_id)
@@ -0,0 +1,339 @@
+# migrate.py
+"""Stream chat data between the app.py and textbox.py formats and storage backends.
+
+The source is a JSON file in either app's layout: ``chat_database.json``
+(top-level ``contacts``, messages addressed with ``receiver``) or
+``chat_data.json`` (contacts nested in ``users``, messages addressed with
+``contact``, images inlined as base64). The file is parsed incrementally,
+one user or message at a time, so multi-gigabyte files never have to fit in
+memory. Output goes to a JSON file in the target app's layout or straight
+into one of the storage backends.
+
+    python migrate.py chat_data.json --to app
+    python migrate.py chat_database.json --to textbox --backend sqlite --output data/
+    python migrate.py chat_data.json --to app --backend json --blob-dir static/blobs
+
+The JSON store keeps the app's JSON file as its base state, so importing a
+file into a directory where it already is that base file is refused: the
+data would be loaded once as the base and imported a second time.
+"""
+import argparse
+import codecs
+import json
+import os
+import sys
+import tempfile
+import time
+
+from blobstore import BlobStore
+from messages import parse_datetime
+from storage import APP_SCHEMAS, open_store
+
+# Characters read from the source per refill of the parse buffer
+READ_CHUNK = 1 << 20
+
+# Messages handed to a store per import_data() call
+BATCH_SIZE = 10000
+
+# Seconds between progress lines
+PROGRESS_SECONDS = 1.0
+
+WHITESPACE = " \t\n\r"
+
+
+class JsonStream:
+    """Incremental JSON reader over a file, decoding one value at a time with ``raw_decode``"""
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+
+    def _fill(self):
+        """Append the next chunk to the buffer, dropping what was already consumed"""
+        if self.eof:
+            return False
+        chunk = self.f.read(READ_CHUNK)
+        self.bytes_read += len(chunk)
+        self.eof = not chunk
+        self.buffer = self.buffer[self.pos:] + self.text.decode(chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, "" at the end"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        """Consume the next non-whitespace character, which must be one of ``chars``"""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} at byte ~{self.bytes_read}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode and consume the next complete JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number or literal touching the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def items(self):
+        """Yield the elements of the array that starts here"""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+    def members(self):
+        """Yield the ``(key, value)`` pairs of the object that starts here"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key, self.value()
+            if self.expect(",}") == "}":
+                return
+
+
+def read_sections(stream):
+    """Yield ``(section, item)`` for a chat file: array elements and object members one by one"""
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        section = stream.value()
+        stream.expect(":")
+        if stream.peek() == "[":
+            for item in stream.items():
+                yield section, item
+        elif stream.peek() == "{":
+            for item in stream.members():
+                yield section, item
+        else:
+            yield section, stream.value()
+        if stream.expect(",}") == "}":
+            return
+
+
+def add_contacts(contacts, username, names):
+    """Merge contact names into a user's list, keeping order and skipping duplicates"""
+    current = contacts.setdefault(username, [])
+    for name in names:
+        if name not in current:
+            current.append(name)
+
+
+def convert_message(message, schema, blobs=None):
+    """Return a message in ``schema``'s shape; inline images move to ``blobs`` when given"""
+    config = APP_SCHEMAS[schema]
+    peer = message.get("receiver", message.get("contact"))
+    converted = {key: value for key, value in message.items() if key not in ("id", "receiver", "contact")}
+    converted[config["peer_key"]] = peer
+    # Re-derive the display time in the target app's format
+    moment = parse_datetime(message.get("timestamp"))
+    if moment is not None:
+        converted["time"] = moment.strftime(config["time_format"])
+    if blobs is not None and converted.get("type") == "image" and converted.get("content", "").startswith("data:"):
+        converted["content"] = blobs.put_data_uri(converted["content"])
+    return converted
+
+
+class FileSink:
+    """Writes a JSON file in the target app's layout; messages stream out as they arrive.
+
+    Users and contacts are small next to the messages, so they are kept until
+    ``close()`` and written after the message array.
+    """
+
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        self.f = os.fdopen(fd, "w")
+        self.f.write('{"messages": [')
+        self.count = 0
+
+    def add_messages(self, messages):
+        for message in messages:
+            if self.count:
+                self.f.write(", ")
+            self.f.write(json.dumps(message))
+            self.count += 1
+
+    def close(self, users, contacts):
+        if self.schema == "textbox":
+            users = {username: dict(info, contacts=contacts.get(username, [])) for username, info in users.items()}
+            self.f.write(f'], "users": {json.dumps(users)}}}')
+        else:
+            self.f.write(f'], "users": {json.dumps(users)}, "contacts": {json.dumps(contacts)}}}')
+        self.f.close()
+        # Replace the target only once it is complete; it may even be the source file
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.f.close()
+        os.unlink(self.tmp_path)
+
+
+class StoreSink:
+    """Imports into a storage backend in batches through ``import_data()``"""
+
+    def __init__(self, backend, directory, schema, blobs=None, source=None):
+        config = APP_SCHEMAS[schema]
+        base_path = os.path.join(directory, config["json"])
+        if backend == "json" and source and os.path.exists(base_path) and os.path.samefile(base_path, source):
+            raise ValueError(
+                f"{source} is already the base file of the JSON store in {directory}; "
+                "importing it there would store every record twice, choose another --output"
+            )
+        os.makedirs(directory, exist_ok=True)
+        self.store = open_store(
+            backend, config["peer_key"],
+            base_path,
+            os.path.join(directory, config["log"]),
+            os.path.join(directory, config["sqlite"]),
+            blobs, config["time_format"]
+        )
+
+    def add_messages(self, messages):
+        self.store.import_data(messages=messages)
+
+    def close(self, users, contacts):
+        self.store.import_data(
+            users=users.items(),
+            contacts=[(username, contact) for username, names in contacts.items() for contact in names]
+        )
+        if hasattr(self.store, "checkpoint"):
+            # Let the apps start from a snapshot instead of replaying the whole import
+            self.store.checkpoint()
+
+    def abort(self):
+        pass
+
+
+class Progress:
+    """Periodic progress and throughput lines on stderr"""
+
+    def __init__(self, total_bytes, out=sys.stderr):
+        self.total_bytes = total_bytes
+        self.out = out
+        self.started = time.perf_counter()
+        self.last = 0.0
+
+    def update(self, stream, messages, users, final=False):
+        now = time.perf_counter()
+        if not final and now - self.last < PROGRESS_SECONDS:
+            return
+        self.last = now
+        elapsed = max(now - self.started, 1e-9)
+        mb = stream.bytes_read / 2 ** 20
+        percent = 100.0 * stream.bytes_read / self.total_bytes if self.total_bytes else 100.0
+        self.out.write(
+            f"\r{messages:,} messages, {users:,} users | {mb:,.1f} MB ({percent:.0f}%) | "
+            f"{messages / elapsed:,.0f} msg/s, {mb / elapsed:,.1f} MB/s"
+        )
+        if final:
+            self.out.write(f" | done in {elapsed:.1f}s\n")
+        self.out.flush()
+
+
+def migrate(source, sink, schema, blobs=None, batch_size=BATCH_SIZE, progress=None):
+    """Stream every record of ``source`` (an open binary file) into ``sink``.
+
+    Returns ``(users, messages)`` counts.
+    """
+    stream = JsonStream(source)
+    users = {}
+    contacts = {}
+    batch = []
+    count = 0
+    try:
+        for section, item in read_sections(stream):
+            if section == "messages":
+                batch.append(convert_message(item, schema, blobs))
+                count += 1
+                if len(batch) >= batch_size:
+                    sink.add_messages(batch)
+                    batch = []
+            elif section == "users":
+                username, info = item
+                info = dict(info)
+                # textbox.py nests contacts inside the user, app.py keeps them top-level
+                add_contacts(contacts, username, info.pop("contacts", []))
+                users[username] = info
+            elif section == "contacts":
+                add_contacts(contacts, *item)
+            if progress:
+                progress.update(stream, count, len(users))
+        if batch:
+            sink.add_messages(batch)
+        sink.close(users, contacts)
+    except BaseException:
+        sink.abort()
+        raise
+    if progress:
+        progress.update(stream, count, len(users), final=True)
+    return len(users), count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("source", help="chat_database.json or chat_data.json to read")
+    parser.add_argument("--to", dest="schema", choices=sorted(APP_SCHEMAS), required=True, help="target app's layout")
+    parser.add_argument(
+        "--backend", choices=["file", "json", "sqlite", "sharded"], default="file",
+        help="write a JSON file (default) or import into a storage backend"
+    )
+    parser.add_argument(
+        "--output",
+        help="target file for --backend file (default: the app's file name), else the data directory (default: .)"
+    )
+    parser.add_argument("--blob-dir", help="move inline base64 images into a blob store at this directory")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="messages per store import batch")
+    parser.add_argument("--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args(argv)
+
+    blobs = BlobStore(args.blob_dir) if args.blob_dir else None
+    if args.backend == "file":
+        sink = FileSink(args.output or APP_SCHEMAS[args.schema]["json"], args.schema)
+    else:
+        try:
+            sink = StoreSink(args.backend, args.output or ".", args.schema, blobs, args.source)
+        except ValueError as e:
+            parser.error(str(e))
+    with open(args.source, "rb") as source:
+        progress = None if args.quiet else Progress(os.fstat(source.fileno()).st_size)
+        migrate(source, sink, args.schema, blobs, args.batch_size, progress)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+# perf.py
+"""Lightweight timing spans and counters for the chat hot paths.
+
+Code wraps the expensive steps of a rerun (loading the store, reading a
+conversation, rendering, writing) in ``metrics.span()`` and reports work done
+(bytes read and written, messages scanned, elements rendered) with
+``metrics.count()``. Span durations, and the counter totals of each rerun,
+are aggregated into fixed-size log-scale histograms, so recording stays cheap
+and memory stays bounded however long the process runs.
+"""
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Relative width of a histogram bucket; percentiles are accurate to about this much
+BUCKET_GROWTH = 1.05
+
+# Percentiles reported for every histogram
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    """Log-bucketed distribution of non-negative values"""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Add one observation"""
+        # Values at or below 1e-6 share bucket None
+        bucket = math.floor(math.log(value, BUCKET_GROWTH)) if value > 1e-6 else None
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add every observation of another histogram, e.g. one from a worker process"""
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Return the value below which ``p`` percent of the observations fall"""
+        if not self.count:
+            return 0.0
+        rank = math.ceil(self.count * p / 100)
+        seen = self.buckets.get(None, 0)
+        if seen >= rank:
+            return 0.0
+        for bucket in sorted(b for b in self.buckets if b is not None):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                # Upper edge of the bucket, never beyond the largest value seen
+                return min(BUCKET_GROWTH ** (bucket + 1), self.max)
+        return self.max
+
+
+class Metrics:
+    """Process-wide span histograms and counters, safe to use from any thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        # Counter totals of the rerun running on this thread, if any
+        self.local = threading.local()
+
+    def observe(self, name, value):
+        """Record a value in the named histogram"""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(value)
+
+    def count(self, name, amount=1):
+        """Add to a counter, both process-wide and for the current rerun"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        tally = getattr(self.local, "tally", None)
+        if tally is not None:
+            tally[name] = tally.get(name, 0) + amount
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block into the ``name`` histogram, in milliseconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def timed(self, name):
+        """Decorator timing every call of a function as a span"""
+        def decorate(fn):
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return fn(*args, **kwargs)
+            wrapper.__name__ = fn.__name__
+            wrapper.__doc__ = fn.__doc__
+            return wrapper
+        return decorate
+
+    @contextmanager
+    def rerun(self, name="rerun"):
+        """Time a script or fragment run and record how much each counter grew during it.
+
+        Nested calls (a fragment running inside the full script run) are timed
+        but their counters are attributed to the outer run.
+        """
+        if getattr(self.local, "tally", None) is not None:
+            with self.span(name):
+                yield
+            return
+        self.local.tally = {}
+        try:
+            with self.span(name):
+                yield
+        finally:
+            tally, self.local.tally = self.local.tally, None
+            for counter, amount in tally.items():
+                self.observe(f"{name}:{counter}", amount)
+
+    def report(self):
+        """Return one row per histogram and counter, sorted by name"""
+        with self.lock:
+            histograms = [
+                dict(
+                    {"name": name, "count": h.count, "mean": h.total / h.count},
+                    **{f"p{p}": h.percentile(p) for p in PERCENTILES},
+                    max=h.max
+                )
+                for name, h in sorted(self.histograms.items())
+            ]
+            counters = [{"name": name, "total": total} for name, total in sorted(self.counters.items())]
+        return {"histograms": histograms, "counters": counters}
+
+    def dump(self, path):
+        """Append the current report as one JSON line to ``path``"""
+        snapshot = dict(self.report(), started=self.started, dumped=time.time())
+        with open(path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+    def reset(self):
+        """Forget every recorded value"""
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+
+# Shared by the apps and the storage layer
+metrics = Metrics()
@@ -0,0 +1,40 @@
+# render_cache.py
+"""Cache of rendered chat-message HTML shared by every session.
+
+Each message's HTML fragment is built once and reused on later reruns until
+the message itself changes. The apps join the fragments of a page into a
+single ``st.markdown`` call instead of emitting one element per message.
+"""
+import threading
+from collections import OrderedDict
+
+from perf import metrics
+
+# Upper bound on cached fragments; least recently used ones are dropped first
+MAX_FRAGMENTS = 5000
+
+
+class FragmentCache:
+    """Bounded LRU map from message identity to its rendered HTML"""
+
+    def __init__(self, max_entries=MAX_FRAGMENTS):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, signature, render, *args):
+        """Return the cached fragment for ``key``, calling ``render(*args)`` when
+        it is missing or was built from a different ``signature``"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self.entries.move_to_end(key)
+                return entry[1]
+        fragment = render(*args)
+        metrics.count("render.fragments_built")
+        with self.lock:
+            self.entries[key] = (signature, fragment)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return fragment
@@ -0,0 +1,140 @@
+# search.py
+"""Inverted index for full-text message search.
+
+Words are lowercased runs of letters and digits. Every word of a text
+message is posted under both participants, so a query only walks the
+searching user's postings and its cost does not grow with the total number
+of stored messages. The JSON store keeps an ``InvertedIndex`` in its
+replayed state; the SQLite store keeps an FTS5 table tokenized the same way.
+"""
+import bisect
+import re
+
+# Letters and digits; underscores and punctuation separate words, as in FTS5's unicode61
+WORD = re.compile(r"[^\W_]+")
+
+# Characters of message text shown per search result
+SNIPPET_CHARS = 80
+
+
+def tokenize(text):
+    """Return the distinct lowercased words of a text"""
+    return set(WORD.findall(text.lower()))
+
+
+def query_terms(query):
+    """Return the words of a search query in order, without duplicates"""
+    return list(dict.fromkeys(WORD.findall(query.lower())))
+
+
+def snippet(text, query, width=SNIPPET_CHARS):
+    """Return a one-line excerpt of ``text`` around the first query word it contains"""
+    lowered = text.lower()
+    positions = [position for position in (lowered.find(term) for term in query_terms(query)) if position >= 0]
+    start = max(0, min(positions, default=0) - width // 4)
+    excerpt = " ".join(text[start:start + width].split())
+    return ("…" if start else "") + excerpt + ("…" if start + width < len(text) else "")
+
+
+def _item_id(item):
+    return item.id
+
+
+def _has_id(ids, item_id):
+    index = bisect.bisect_left(ids, item_id)
+    return index < len(ids) and ids[index] == item_id
+
+
+def matching_ids(postings, terms, before=None):
+    """Return the ids posted under every term in ``{word: [id, ...]}`` postings, below ``before``, ascending"""
+    lists = [postings.get(term) for term in terms]
+    if not lists or not all(lists):
+        return []
+    lists.sort(key=len)
+    rarest, others = lists[0], lists[1:]
+    end = len(rarest) if before is None else bisect.bisect_left(rarest, before)
+    return [item_id for item_id in rarest[:end] if all(_has_id(ids, item_id) for ids in others)]
+
+
+class InvertedIndex:
+    """Postings per owner and word, each a list of items in increasing ``id`` order.
+
+    Items are added as they are stored, so appending keeps every list sorted
+    and queries page backwards from an id cursor with a binary search.
+    """
+
+    def __init__(self):
+        self.postings = {}
+
+    def add(self, owners, text, item):
+        """Post ``item`` under every word of ``text`` for each owner"""
+        for owner in owners:
+            words = self.postings.setdefault(owner, {})
+            for word in tokenize(text):
+                words.setdefault(word, []).append(item)
+
+    def search(self, owner, terms, accept=None, limit=None, before=None):
+        """Return the owner's items containing every term, newest first.
+
+        Only items with an id below ``before`` and for which ``accept(item)``
+        is true are returned, at most ``limit`` of them.
+        """
+        words = self.postings.get(owner, {})
+        lists = [words.get(term) for term in terms]
+        if not lists or not all(lists):
+            return []
+        # Walk the rarest word's postings and look the others up by id
+        lists.sort(key=len)
+        rarest, others = lists[0], lists[1:]
+        end = len(rarest) if before is None else bisect.bisect_left(rarest, before, key=_item_id)
+        hits = []
+        for index in range(end - 1, -1, -1):
+            item = rarest[index]
+            if all(self._contains(postings, item.id) for postings in others) and (accept is None or accept(item)):
+                hits.append(item)
+                if len(hits) == limit:
+                    break
+        return hits
+
+    @staticmethod
+    def _contains(postings, item_id):
+        index = bisect.bisect_left(postings, item_id, key=_item_id)
+        return index < len(postings) and postings[index].id == item_id
+
+    def words(self, owner):
+        """Return the words the owner has postings under"""
+        return list(self.postings.get(owner, ()))
+
+    def filtered(self, owner, word, keep):
+        """Return ``(kept, scanned)`` for one word without changing the index.
+
+        ``kept`` holds the items among the first ``scanned`` postings for
+        which ``keep(item)`` is true; ``replace`` swaps them in later.
+        """
+        postings = self.postings.get(owner, {}).get(word, [])
+        scanned = len(postings)
+        return [item for item in postings[:scanned] if keep(item)], scanned
+
+    def replace(self, owner, word, kept, scanned):
+        """Put ``kept`` in place of a word's first ``scanned`` postings; items added since stay"""
+        words = self.postings.get(owner)
+        if words is None:
+            return
+        kept.extend(words.get(word, [])[scanned:])
+        if kept:
+            words[word] = kept
+        else:
+            words.pop(word, None)
+
+    def prune(self, owners, keep):
+        """Drop the owners' items for which ``keep(item)`` is false"""
+        for owner in owners:
+            words = self.postings.get(owner)
+            if not words:
+                continue
+            for word, postings in list(words.items()):
+                kept = [item for item in postings if keep(item)]
+                if kept:
+                    words[word] = kept
+                else:
+                    del words[word]
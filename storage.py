@@ -0,0 +1,1279 @@
+# storage.py
+"""Pluggable storage engines for app.py and textbox.py.
+
+``ChatStore`` is the interface both apps use for users, contacts, messages
+and images. Three backends implement it:
+
+* ``JsonLogStore`` - the original JSON file as base state plus the
+  append-only change log from chatlog.py, with cold conversations moved
+  into compressed segments from archive.py.
+* ``SqliteStore`` - an embedded SQLite database in WAL mode, where a send is
+  a single-row insert and opening a chat is an indexed range scan.
+* ``ShardedStore`` - users and contacts in one SQLite file, messages spread
+  over shard files by conversation, so sends to different chats never
+  contend for the same write lock.
+
+All of them keep a full-text index of text messages, updated with every send.
+
+Messages are plain dicts in the owning app's shape. ``peer_key`` names the
+field holding the other participant: "receiver" in app.py, "contact" in
+textbox.py. Image messages carry a blob id from blobstore.py as content;
+messages written before the blob store keep their inline data URI.
+"""
+import bisect
+import datetime
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import zlib
+
+from archive import Archive
+from chatlog import (
+    CachedLog, conversation_key, conversation_page, file_signature, read_records,
+    read_snapshot, write_snapshot
+)
+from compactor import COMPACTION_CHUNK, Compactor
+from events import USERS_TOPIC, EventBus, conversation_topic, user_topic
+from messages import Message, cursor_key, parse_timestamp
+from perf import metrics
+from search import InvertedIndex, matching_ids, query_terms, tokenize
+from writer import GroupCommitWriter
+
+# Columns stored for every message; any other field goes into the JSON "extra" column
+MESSAGE_FIELDS = ("id", "type", "sender", "content", "time", "timestamp")
+
+# File names, peer field and display time format of each app's data, as in the apps
+APP_SCHEMAS = {
+    "app": {
+        "json": "chat_database.json",
+        "log": "chat_database.log",
+        "sqlite": "chat_database.sqlite3",
+        "peer_key": "receiver",
+        "time_format": "%I:%M %p"
+    },
+    "textbox": {
+        "json": "chat_data.json",
+        "log": "chat_data.log",
+        "sqlite": "chat_data.sqlite3",
+        "peer_key": "contact",
+        "time_format": "%H:%M"
+    }
+}
+
+# Log bytes written after the last snapshot before a new one is taken
+SNAPSHOT_MIN_BYTES = 1 << 20
+
+# Seconds between checks whether the JSON store needs a new snapshot
+SNAPSHOT_INTERVAL = 300
+
+# Search postings filtered per compaction step; only the swap of the kept ones holds the lock
+PRUNE_CHUNK = 20 * COMPACTION_CHUNK
+
+# Message shard files per sharded store; fixed once the store holds data
+SHARD_COUNT = 8
+
+
+class ChatStore:
+    """Interface implemented by every storage backend.
+
+    Every committed write is published on ``events`` so sessions know when
+    to re-query.
+    """
+
+    def __init__(self, peer_key, blobs=None, events=None):
+        self.peer_key = peer_key
+        self.blobs = blobs
+        # Stores combined into one (the shards of a ShardedStore) publish on a shared bus
+        self.events = events or EventBus()
+
+    def _publish_user(self, username):
+        self.events.publish(USERS_TOPIC, user_topic(username))
+
+    def _publish_contact(self, username):
+        self.events.publish(user_topic(username))
+
+    def _publish_conversation(self, user_a, user_b):
+        self.events.publish(conversation_topic(user_a, user_b), user_topic(user_a), user_topic(user_b))
+
+    # Users
+
+    def get_user(self, username):
+        """Return the user's info dict, or None if not registered"""
+        raise NotImplementedError
+
+    def add_user(self, username, info):
+        """Register a user; return False if the username is taken"""
+        raise NotImplementedError
+
+    def find_users(self, prefix="", limit=None, after=None):
+        """Return usernames starting with ``prefix`` in sorted order.
+
+        With ``after``, only names sorting after it are returned, so a
+        listing pages forward from the last name shown; at most ``limit``.
+        """
+        raise NotImplementedError
+
+    def user_count(self):
+        """Return the number of registered users"""
+        raise NotImplementedError
+
+    # Contacts
+
+    def get_contacts(self, username):
+        """Return the user's contacts in the order they were added"""
+        raise NotImplementedError
+
+    def add_contact(self, username, contact):
+        """Add a contact to the user's list; return False if already present"""
+        raise NotImplementedError
+
+    # Messages
+
+    def add_message(self, message):
+        """Store a new message once it is durably committed; return its id"""
+        raise NotImplementedError
+
+    def get_conversation(self, user_a, user_b, limit=None, before=None):
+        """Return messages between two users in timestamp order.
+
+        With ``limit``, only the newest ``limit`` messages are returned; with
+        ``before`` (a ``(timestamp, id)`` cursor from ``message_cursor()``),
+        only messages strictly older than the cursor.
+        """
+        raise NotImplementedError
+
+    def get_messages_since(self, user_a, user_b, after_id):
+        """Return messages between two users stored after the message ``after_id``.
+
+        Ids grow with every stored message, so a session polling with the
+        last id it has seen only reads what is new.
+        """
+        raise NotImplementedError
+
+    def clear_conversation(self, user_a, user_b):
+        """Delete every message between two users.
+
+        Only a tombstone is written; reads skip the cleared messages at once
+        and a background compactor reclaims their space later.
+        """
+        raise NotImplementedError
+
+    def search_messages(self, username, query, contact=None, limit=None, before=None):
+        """Return the user's text messages containing every word of ``query``, newest first.
+
+        With ``contact``, only the conversation with that user is searched;
+        ``before`` is a message id to continue after the previous page.
+        """
+        raise NotImplementedError
+
+    def message_count(self):
+        """Return the total number of stored messages"""
+        raise NotImplementedError
+
+    def conversation_message_count(self, user_a, user_b):
+        """Return the number of messages between two users"""
+        raise NotImplementedError
+
+    # Bulk import
+
+    def import_data(self, users=(), contacts=(), messages=()):
+        """Store many records at once, committing them in large batches.
+
+        ``users`` holds ``(username, info)`` pairs, ``contacts`` holds
+        ``(username, contact)`` pairs and ``messages`` holds message dicts.
+        Existing users and contacts are left untouched.
+        """
+        raise NotImplementedError
+
+    def _publish_import(self, users, contacts, messages):
+        for username, _ in users:
+            self._publish_user(username)
+        for username in {username for username, _ in contacts}:
+            self._publish_contact(username)
+        for user_a, user_b in {conversation_key(m["sender"], m[self.peer_key]) for m in messages}:
+            self._publish_conversation(user_a, user_b)
+
+    # Images
+
+    def image_src(self, ref):
+        """Return a URL for an image reference usable as an <img> source"""
+        if ref.startswith("data:"):
+            return ref
+        return self.blobs.url(ref)
+
+
+class JsonLogStore(ChatStore):
+    """JSON base file plus append-only change log, replayed into memory once per process.
+
+    Messages are held as compact ``Message`` records and logged as rows;
+    reads convert them back to dicts in the app's shape, deriving the display
+    time with ``time_format``.
+
+    Appends from every session are group-committed by one background writer:
+    each batch is a single write and a single fsync. A clear drops the
+    conversation from the indexes and leaves a tombstone; the compactor then
+    removes the cleared messages from the message list in chunks.
+
+    Startup loads the latest snapshot and replays only the log after it. A
+    background thread writes a new snapshot once enough log has accumulated,
+    rebuilding it from the previous snapshot and the log tail so the shared
+    state is never locked for it.
+
+    With ``archive_after`` (a timedelta), the same thread first moves
+    conversations without a message that recent into an archive segment.
+    An "archive" record in the log drops them from the hot state, so the
+    snapshot and memory only hold active chats. Reads go to the segment
+    only when a page, poll or search reaches past the hot messages.
+    """
+
+    def __init__(self, base_path, log_path, peer_key, blobs=None, snapshot_path=None, time_format=None,
+                 archive_after=None):
+        super().__init__(peer_key, blobs)
+        self.base_path = base_path
+        self.time_format = time_format
+        self.snapshot_path = snapshot_path or os.path.splitext(log_path)[0] + ".snapshot"
+        self.archive_after = archive_after
+        self.archive = Archive(os.path.splitext(log_path)[0] + ".archive")
+        # Log offset covered by the newest snapshot this process knows of
+        self.snapshot_offset = 0
+        self.snapshot_lock = threading.Lock()
+        self.cache = CachedLog(log_path, self._load_base, self._apply, self._load_snapshot)
+        self.writer = GroupCommitWriter(self._flush_records, name="json-log-writer")
+        self.compaction = None
+        self.search_prune = None
+        self.compactor = Compactor(self._compact_step, name="json-log-compactor")
+        self.snapshotter = Compactor(self._snapshot_step, name="json-log-snapshot", idle_interval=SNAPSHOT_INTERVAL)
+
+    def _flush_records(self, records):
+        # Number new messages here so senders learn their id; replay keeps these ids.
+        # Duplicate users and contacts are rejected here too: the lock keeps other
+        # processes from appending between reading the state and the write.
+        with self.cache.exclusive():
+            state = self.cache.get()
+            next_id = state["next_id"]
+            registered = set()
+            added = set()
+            results = []
+            encoded = []
+            for record in records:
+                op = record["op"]
+                if op == "message":
+                    message = record["message"]
+                    message.id = next_id
+                    next_id += 1
+                    results.append(message.id)
+                    # Messages are logged as compact rows rather than dicts
+                    record = {"op": "message", "row": message.to_row()}
+                elif op == "register":
+                    username = record["username"]
+                    if username in state["users"] or username in registered:
+                        results.append(False)
+                        continue
+                    registered.add(username)
+                    results.append(True)
+                elif op == "add_contact":
+                    pair = (record["username"], record["contact"])
+                    if pair[1] in state["contacts"].get(pair[0], []) or pair in added:
+                        results.append(False)
+                        continue
+                    added.add(pair)
+                    results.append(True)
+                else:
+                    results.append(None)
+                encoded.append(record)
+            if encoded:
+                self.cache.append_many(encoded, sync=True)
+        if os.path.getsize(self.cache.path) - self.snapshot_offset > SNAPSHOT_MIN_BYTES:
+            self.snapshotter.wake()
+        return results
+
+    def _write(self, record):
+        """Append a record through the group-commit writer and wait until it is synced"""
+        return self.writer.write(record)
+
+    def _to_message(self, data):
+        return Message.from_dict(data, self.peer_key, self.time_format)
+
+    def _to_dict(self, message):
+        return message.to_dict(self.peer_key, self.time_format)
+
+    def _empty_state(self):
+        return {
+            "users": {},
+            # Usernames in sorted order, for prefix search and paging
+            "directory": [],
+            "contacts": {},
+            "messages": [],
+            # Messages per unordered user pair, already in timestamp order
+            "conversations": {},
+            # Messages per unordered user pair in id order, for since-cursor polling
+            "arrivals": {},
+            # Highest cleared message id per unordered user pair
+            "tombstones": {},
+            # Archived chunks per unordered user pair, oldest first: segment
+            # name, message count, id range and first and last sort key
+            "archived": {},
+            # Archived user pairs per participant, for searching a user's archived chats
+            "archived_keys": {},
+            # Live archived messages per unordered user pair and in total
+            "archived_counts": {},
+            "archived_total": 0,
+            # Archive segments written so far, for naming the next one
+            "segments": 0,
+            # Text messages per participant and word
+            "search": InvertedIndex(),
+            # Cleared user pairs whose messages are still in the search index
+            "search_stale": set(),
+            # Cleared or archived messages still in the message list, waiting for compaction
+            "hidden": 0,
+            "clears": 0,
+            "next_id": 1
+        }
+
+    def _load_base(self):
+        """Load the JSON file written by older versions as the starting state"""
+        state = self._empty_state()
+        if not os.path.exists(self.base_path):
+            return state
+        with metrics.span("store.load_base"), open(self.base_path, 'r') as f:
+            data = json.load(f)
+        metrics.count("store.bytes_read", os.path.getsize(self.base_path))
+        for username, info in data.get("users", {}).items():
+            info = dict(info)
+            # textbox.py nests contacts inside the user, app.py keeps them top-level
+            state["contacts"][username] = info.pop("contacts", [])
+            state["users"][username] = info
+        state["contacts"].update(data.get("contacts", {}))
+        state["directory"] = sorted(state["users"])
+        for message in data.get("messages", []):
+            self._apply_message(state, self._to_message(message))
+        metrics.count("store.messages_scanned", len(state["messages"]))
+        return state
+
+    def _read_snapshot(self):
+        """Return ``(state, offset)`` from the snapshot file if it still matches the base file and log"""
+        with metrics.span("store.load_snapshot"):
+            snapshot = read_snapshot(self.snapshot_path)
+        if snapshot is None or snapshot.get("peer_key") != self.peer_key:
+            return None
+        log_signature = file_signature(self.cache.path)
+        if (log_signature is None or log_signature[0] != snapshot["log_inode"] or
+                log_signature[1] < snapshot["offset"] or
+                file_signature(self.base_path) != snapshot["base_signature"]):
+            return None
+        return snapshot["state"], snapshot["offset"]
+
+    def _load_snapshot(self):
+        loaded = self._read_snapshot()
+        if loaded is None:
+            # Take a snapshot soon so the next start is fast
+            self.snapshot_offset = 0
+            self.snapshotter.wake()
+            return None
+        self.snapshot_offset = loaded[1]
+        metrics.count("store.bytes_read", os.path.getsize(self.snapshot_path))
+        return loaded
+
+    def checkpoint(self):
+        """Write a snapshot covering everything logged so far, waiting until it is done"""
+        self._snapshot_step(force=True)
+
+    def _snapshot_step(self, force=False):
+        """Archive cold conversations, then write a new snapshot from the previous one plus the log since"""
+        with self.snapshot_lock:
+            if self.archive_after is not None and self.archive_cold(self.archive_after):
+                # The hot state just shrank, so let the next start load the smaller snapshot
+                force = True
+            self._write_snapshot(force)
+        return False
+
+    def _write_snapshot(self, force):
+        log_signature = file_signature(self.cache.path)
+        if log_signature is None and not force:
+            return
+        # Decide from the offset this process knows before unpickling the previous snapshot;
+        # a forced snapshot skips the thresholds, and only it gets here without a log file
+        if not force and self.snapshot_offset and log_signature[1] - self.snapshot_offset < SNAPSHOT_MIN_BYTES:
+            return
+        previous = self._read_snapshot()
+        if not force and previous is not None and log_signature[1] - previous[1] < SNAPSHOT_MIN_BYTES:
+            # Another process wrote a newer snapshot meanwhile
+            self.snapshot_offset = previous[1]
+            return
+        base_signature = file_signature(self.base_path)
+        state, offset = previous or (self._load_base(), 0)
+        for record, offset in read_records(self.cache.path, offset):
+            self._apply(state, record)
+        # This copy is private, so cleared messages can be dropped in one pass
+        state["messages"] = [m for m in state["messages"] if not self._is_removed(state, m)]
+        state["hidden"] = 0
+        self._prune_search(state)
+        if log_signature is None:
+            # Snapshots are tied to a log file, so make sure one exists
+            open(self.cache.path, "ab").close()
+            log_signature = file_signature(self.cache.path)
+        write_snapshot(self.snapshot_path, {
+            "peer_key": self.peer_key,
+            "log_inode": log_signature[0],
+            "offset": offset,
+            "base_signature": base_signature,
+            "state": state
+        })
+        self.snapshot_offset = offset
+
+    def _apply_message(self, state, message):
+        # Keep the id assigned at write time unless another process already used it
+        if not isinstance(message.id, int) or message.id < state["next_id"]:
+            message.id = state["next_id"]
+        state["next_id"] = message.id + 1
+        state["messages"].append(message)
+        key = conversation_key(message.sender, message.peer)
+        chat = state["conversations"].setdefault(key, [])
+        if not chat or chat[-1].sort_key() <= message.sort_key():
+            chat.append(message)
+        else:
+            bisect.insort(chat, message, key=Message.sort_key)
+        state["arrivals"].setdefault(key, []).append(message)
+        if message.type == "text":
+            state["search"].add({message.sender, message.peer}, message.content, message)
+
+    def _apply(self, state, record):
+        """Apply one logged change to the in-memory state"""
+        op = record["op"]
+        if op == "register":
+            if record["username"] not in state["users"]:
+                info = dict(record["user"])
+                state["contacts"].setdefault(record["username"], info.pop("contacts", []))
+                state["users"][record["username"]] = info
+                bisect.insort(state["directory"], record["username"])
+        elif op == "init_contacts":
+            state["contacts"].setdefault(record["username"], [])
+        elif op == "add_contact":
+            contacts = state["contacts"].setdefault(record["username"], [])
+            if record["contact"] not in contacts:
+                contacts.append(record["contact"])
+        elif op == "message":
+            self._apply_message(state, Message.from_row(record["row"]))
+        elif op == "clear_chat":
+            # Everything replayed so far in this conversation is cleared
+            key = conversation_key(record["user"], record["contact"])
+            state["tombstones"][key] = state["next_id"] - 1
+            state["clears"] += 1
+            state["archived_total"] -= state["archived_counts"].pop(key, 0)
+            state["hidden"] += len(state["conversations"].pop(key, []))
+            state["arrivals"].pop(key, None)
+            state["search_stale"].add(key)
+        elif op == "archive":
+            # Messages up to each archived id leave the hot indexes; newer ones stay
+            state["segments"] += 1
+            for user_a, user_b, count, min_id, max_id, first, last in record["conversations"]:
+                key = conversation_key(user_a, user_b)
+                if key not in state["archived"]:
+                    for username in set(key):
+                        state["archived_keys"].setdefault(username, []).append(key)
+                state["archived"].setdefault(key, []).append({
+                    "segment": record["segment"], "count": count, "min_id": min_id, "max_id": max_id,
+                    "first": tuple(first), "last": tuple(last)
+                })
+                state["archived_counts"][key] = state["archived_counts"].get(key, 0) + count
+                state["archived_total"] += count
+                chat = state["conversations"].pop(key, [])
+                hot = [message for message in chat if message.id > max_id]
+                state["hidden"] += len(chat) - len(hot)
+                arrivals = [message for message in state["arrivals"].pop(key, []) if message.id > max_id]
+                if hot:
+                    state["conversations"][key] = hot
+                    state["arrivals"][key] = arrivals
+                state["search_stale"].add(key)
+            # Counts as a clear for a compaction pass that is under way
+            state["clears"] += 1
+
+    def get_user(self, username):
+        return self.cache.get()["users"].get(username)
+
+    def add_user(self, username, info):
+        if username in self.cache.get()["users"]:
+            return False
+        # The writer checks again under the log lock, where concurrent registrations are serialized
+        if not self._write({"op": "register", "username": username, "user": info}):
+            return False
+        self._publish_user(username)
+        return True
+
+    def find_users(self, prefix="", limit=None, after=None):
+        directory = self.cache.get()["directory"]
+        start = bisect.bisect_left(directory, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(directory, after))
+        # Names with the prefix sort before the prefix followed by U+10FFFF, as in SQLite
+        end = bisect.bisect_left(directory, prefix + "\U0010ffff", lo=start)
+        if limit is not None:
+            end = min(end, start + limit)
+        return directory[start:end]
+
+    def user_count(self):
+        return len(self.cache.get()["users"])
+
+    def get_contacts(self, username):
+        return list(self.cache.get()["contacts"].get(username, []))
+
+    def add_contact(self, username, contact):
+        if contact in self.cache.get()["contacts"].get(username, []):
+            return False
+        if not self._write({"op": "add_contact", "username": username, "contact": contact}):
+            return False
+        self._publish_contact(username)
+        return True
+
+    def add_message(self, message):
+        message_id = self._write({"op": "message", "message": self._to_message(message)})
+        self._publish_conversation(message["sender"], message[self.peer_key])
+        return message_id
+
+    def get_conversation(self, user_a, user_b, limit=None, before=None):
+        with metrics.span("store.get_conversation"):
+            state = self.cache.get()
+            key = conversation_key(user_a, user_b)
+            before = None if before is None else cursor_key(before)
+            page = conversation_page(state["conversations"].get(key, []), limit, before, key=Message.sort_key)
+            for chunk in reversed(self._archived_chunks(state, key)):
+                # Only read the archive when the page reaches back into it
+                if before is not None and chunk["first"] >= before:
+                    continue
+                if limit is not None and len(page) == limit and chunk["last"] < page[0].sort_key():
+                    continue
+                older = conversation_page(
+                    self.archive.read(chunk["segment"], key), limit, before, key=Message.sort_key
+                )
+                page = list(heapq.merge(older, page, key=Message.sort_key))
+                if limit is not None:
+                    page = page[-limit:]
+            page = [self._to_dict(message) for message in page]
+        metrics.count("store.messages_scanned", len(page))
+        return page
+
+    def get_messages_since(self, user_a, user_b, after_id):
+        with metrics.span("store.get_messages_since"):
+            state = self.cache.get()
+            key = conversation_key(user_a, user_b)
+            arrivals = state["arrivals"].get(key, [])
+            new_messages = arrivals[bisect.bisect_right(arrivals, after_id, key=lambda m: m.id):]
+            for chunk in self._archived_chunks(state, key):
+                if chunk["max_id"] > after_id:
+                    archived = sorted(
+                        (m for m in self.archive.read(chunk["segment"], key) if m.id > after_id), key=lambda m: m.id
+                    )
+                    new_messages = list(heapq.merge(archived, new_messages, key=lambda m: m.id))
+            new_messages = [self._to_dict(message) for message in new_messages]
+        metrics.count("store.messages_scanned", len(new_messages))
+        return new_messages
+
+    def clear_conversation(self, user_a, user_b):
+        self._write({"op": "clear_chat", "user": user_a, "contact": user_b})
+        self._publish_conversation(user_a, user_b)
+        self.compactor.wake()
+
+    def _is_cleared(self, state, message):
+        return message.id <= state["tombstones"].get(conversation_key(message.sender, message.peer), 0)
+
+    def _is_removed(self, state, message):
+        """Whether a message left the hot state, by a clear or into the archive"""
+        if self._is_cleared(state, message):
+            return True
+        chunks = state["archived"].get(conversation_key(message.sender, message.peer))
+        return bool(chunks) and message.id <= chunks[-1]["max_id"]
+
+    def _archived_chunks(self, state, key):
+        """Return the conversation's archived chunks not covered by a clear, oldest first"""
+        cleared = state["tombstones"].get(key, 0)
+        # A clear covers either all of a chunk or none of it
+        return [chunk for chunk in state["archived"].get(key, []) if chunk["max_id"] > cleared]
+
+    def archive_cold(self, max_age):
+        """Move conversations without a message newer than ``max_age`` into a new archive segment.
+
+        Returns the number of messages archived.
+        """
+        cutoff = parse_timestamp((datetime.datetime.now() - max_age).isoformat())
+        state = self.cache.get()
+        cold = {}
+        ids = {}
+
+        def copy_cold(state):
+            # Replaying the log extends these lists in place, so they are copied under the lock
+            for key, chat in state["conversations"].items():
+                arrivals = state["arrivals"].get(key)
+                if chat and arrivals and chat[-1].sort_key()[0] < cutoff:
+                    cold[key] = list(chat)
+                    ids[key] = (arrivals[0].id, arrivals[-1].id)
+
+        if not self.cache.update(state, copy_cold) or not cold:
+            return 0
+        # Written without the lock, so the name must not clash with another process's segment
+        name = f"{state['segments'] + 1:06d}-{uuid.uuid4().hex[:8]}.seg"
+        with metrics.span("store.archive"):
+            self.archive.write(name, cold)
+        with self.cache.exclusive():
+            state = self.cache.get()
+            conversations = []
+            for key, chat in cold.items():
+                min_id, max_id = ids[key]
+                arrivals = state["arrivals"].get(key)
+                if not arrivals or arrivals[-1].id != max_id:
+                    # A message or a clear came in since the copy was taken; keep it hot
+                    continue
+                conversations.append([
+                    *key, len(chat), min_id, max_id, list(chat[0].sort_key()), list(chat[-1].sort_key())
+                ])
+            if conversations:
+                self.cache.append_many([{"op": "archive", "segment": name, "conversations": conversations}], sync=True)
+        if not conversations:
+            os.unlink(self.archive.path(name))
+            return 0
+        archived = sum(count for _, _, count, *_ in conversations)
+        metrics.count("store.messages_archived", archived)
+        self.compactor.wake()
+        return archived
+
+    def _prune_search(self, state):
+        """Remove cleared and archived messages from the search postings of their participants"""
+        owners = {username for key in state["search_stale"] for username in key}
+        state["search"].prune(owners, lambda message: not self._is_removed(state, message))
+        state["search_stale"].clear()
+
+    def _compact_step(self):
+        """Run one bounded step of compaction: the message list first, then the search postings"""
+        state = self.cache.get()
+        if state["hidden"]:
+            return self._compact_messages(state)
+        self.compaction = None
+        if state["search_stale"]:
+            return self._prune_search_step(state)
+        self.search_prune = None
+        return False
+
+    def _prune_search_step(self, state):
+        """Filter the postings of a few words outside the lock and swap them in under it"""
+        job = self.search_prune
+        if job is None or job["state"] is not state:
+            stale = set(state["search_stale"])
+            owners = {username for key in stale for username in key}
+            job = self.search_prune = {
+                "state": state, "clears": state["clears"], "stale": stale,
+                "pending": [(owner, word) for owner in owners for word in state["search"].words(owner)]
+            }
+        index = state["search"]
+        results = []
+        scanned = 0
+        while job["pending"] and scanned < PRUNE_CHUNK:
+            owner, word = job["pending"].pop()
+            kept, count = index.filtered(owner, word, lambda message: not self._is_removed(state, message))
+            results.append((owner, word, kept, count))
+            scanned += count
+        metrics.count("store.postings_scanned", scanned)
+
+        def swap(state):
+            for owner, word, kept, count in results:
+                index.replace(owner, word, kept, count)
+            if not job["pending"] and state["clears"] == job["clears"]:
+                # Keys cleared again meanwhile stay stale for another pass
+                state["search_stale"] -= job["stale"]
+
+        if not self.cache.update(state, swap) or not job["pending"]:
+            self.search_prune = None
+        return True
+
+    def _compact_messages(self, state):
+        """Filter one chunk of the message list; swap in the result after the last chunk"""
+        job = self.compaction
+        if job is None or job["state"] is not state:
+            # Start over if the state was rebuilt from disk meanwhile
+            job = self.compaction = {"state": state, "clears": state["clears"], "scanned": 0, "kept": []}
+        messages = state["messages"]
+        # The list only grows between swaps, so chunks can be read without the lock
+        chunk = messages[job["scanned"]:job["scanned"] + COMPACTION_CHUNK]
+        job["kept"].extend(m for m in chunk if not self._is_removed(state, m))
+        job["scanned"] += len(chunk)
+        metrics.count("store.messages_scanned", len(chunk))
+        if job["scanned"] < len(messages):
+            return True
+
+        def swap(state):
+            # Messages appended since the last chunk are checked under the lock
+            tail = state["messages"][job["scanned"]:]
+            kept = job["kept"] + [m for m in tail if not self._is_removed(state, m)]
+            if state["clears"] == job["clears"]:
+                # No clear since the scan began, so every cleared message is gone
+                state["hidden"] = 0
+            else:
+                state["hidden"] -= len(state["messages"]) - len(kept)
+            state["messages"] = kept
+
+        self.cache.update(state, swap)
+        self.compaction = None
+        # Check again in case another clear came in while scanning
+        return True
+
+    def import_data(self, users=(), contacts=(), messages=()):
+        users, contacts, messages = list(users), list(contacts), list(messages)
+        state = self.cache.get()
+        records = [
+            {"op": "register", "username": username, "user": info}
+            for username, info in users if username not in state["users"]
+        ]
+        records.extend({"op": "add_contact", "username": username, "contact": contact} for username, contact in contacts)
+        records.extend({"op": "message", "message": self._to_message(message)} for message in messages)
+        # Queue everything before waiting so the writer fills whole batches
+        for future in [self.writer.submit(record) for record in records]:
+            future.result()
+        self._publish_import(users, contacts, messages)
+
+    def _search_archive(self, state, username, terms, key, limit, before, hits):
+        """Add matching archived messages to the newest-first ``hits`` of the hot index.
+
+        Matches come from the postings stored with each archived chunk; only
+        the chunks holding messages of the final page are decompressed.
+        """
+        keys = [key] if key is not None else state["archived_keys"].get(username, [])
+        chunks = sorted(
+            (
+                (chunk, chat_key) for chat_key in keys for chunk in self._archived_chunks(state, chat_key)
+                if before is None or chunk["min_id"] < before
+            ),
+            key=lambda item: item[0]["max_id"], reverse=True
+        )
+        # The newest ``limit`` ids found so far, hot and archived, as a min-heap
+        newest = [message.id for message in hits]
+        heapq.heapify(newest)
+        found = []
+        for chunk, chat_key in chunks:
+            if limit is not None and len(newest) == limit and newest[0] > chunk["max_id"]:
+                # Chunks are visited newest first, so the rest all end below the page
+                break
+            for message_id in matching_ids(self.archive.postings(chunk["segment"], chat_key), terms, before):
+                found.append((message_id, chunk["segment"], chat_key))
+                heapq.heappush(newest, message_id)
+                if limit is not None and len(newest) > limit:
+                    heapq.heappop(newest)
+        if not found:
+            return hits
+        wanted = {message_id: (segment, chat_key) for message_id, segment, chat_key in found if message_id >= newest[0]}
+        archived = [
+            message for segment, chat_key in set(wanted.values())
+            for message in self.archive.read(segment, chat_key) if message.id in wanted
+        ]
+        return sorted(hits + archived, key=lambda m: m.id, reverse=True)[:limit]
+
+    def search_messages(self, username, query, contact=None, limit=None, before=None):
+        with metrics.span("store.search"):
+            state = self.cache.get()
+            key = None if contact is None else conversation_key(username, contact)
+            terms = query_terms(query)
+
+            def accept(message):
+                if key is not None and conversation_key(message.sender, message.peer) != key:
+                    return False
+                return not self._is_removed(state, message)
+
+            hits = state["search"].search(username, terms, accept, limit, before)
+            if terms:
+                # Archived messages left the index; their chunks carry postings of their own
+                hits = self._search_archive(state, username, terms, key, limit, before, hits)
+            hits = [self._to_dict(message) for message in hits]
+        metrics.count("store.search_results", len(hits))
+        return hits
+
+    def message_count(self):
+        state = self.cache.get()
+        return len(state["messages"]) - state["hidden"] + state["archived_total"]
+
+    def conversation_message_count(self, user_a, user_b):
+        state = self.cache.get()
+        key = conversation_key(user_a, user_b)
+        # The conversation index is updated per record, so its length is the hot count
+        return len(state["conversations"].get(key, [])) + state["archived_counts"].get(key, 0)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    info TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contacts (
+    username TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    UNIQUE (username, contact)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    peer TEXT NOT NULL,
+    type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    time TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, timestamp, id);
+CREATE INDEX IF NOT EXISTS messages_by_arrival ON messages (conversation, id);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('users', 0), ('messages', 0);
+CREATE TABLE IF NOT EXISTS conversation_counts (
+    conversation TEXT PRIMARY KEY,
+    messages INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS count_user_insert AFTER INSERT ON users BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'users';
+END;
+CREATE TRIGGER IF NOT EXISTS count_user_delete AFTER DELETE ON users BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'users';
+END;
+CREATE TRIGGER IF NOT EXISTS count_message_insert AFTER INSERT ON messages BEGIN
+    UPDATE counters SET value = value + 1 WHERE name = 'messages';
+    INSERT INTO conversation_counts (conversation, messages) VALUES (NEW.conversation, 1)
+        ON CONFLICT (conversation) DO UPDATE SET messages = messages + 1;
+END;
+CREATE TABLE IF NOT EXISTS tombstones (
+    conversation TEXT PRIMARY KEY,
+    max_id INTEGER NOT NULL,
+    pending INTEGER NOT NULL DEFAULT 1
+);
+CREATE TRIGGER IF NOT EXISTS count_tombstone AFTER INSERT ON tombstones BEGIN
+    UPDATE counters SET value = value - IFNULL(
+        (SELECT messages FROM conversation_counts WHERE conversation = NEW.conversation), 0
+    ) WHERE name = 'messages';
+    UPDATE conversation_counts SET messages = 0 WHERE conversation = NEW.conversation;
+END;
+CREATE TRIGGER IF NOT EXISTS count_message_delete AFTER DELETE ON messages
+WHEN OLD.id > IFNULL((SELECT max_id FROM tombstones WHERE conversation = OLD.conversation), 0) BEGIN
+    UPDATE counters SET value = value - 1 WHERE name = 'messages';
+    UPDATE conversation_counts SET messages = messages - 1 WHERE conversation = OLD.conversation;
+END;
+"""
+
+# Full-text index of text messages, kept in step with the messages table by triggers.
+# Created and backfilled in one transaction so no message is indexed twice or missed.
+SEARCH_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE VIRTUAL TABLE IF NOT EXISTS message_search USING fts5(
+    body, participants, content='', tokenize='unicode61 remove_diacritics 0'
+);
+CREATE TRIGGER IF NOT EXISTS index_message_insert AFTER INSERT ON messages WHEN NEW.type = 'text' BEGIN
+    INSERT INTO message_search (rowid, body, participants)
+        VALUES (NEW.id, NEW.content, NEW.sender || ' ' || NEW.peer);
+END;
+CREATE TRIGGER IF NOT EXISTS index_message_delete AFTER DELETE ON messages WHEN OLD.type = 'text' BEGIN
+    INSERT INTO message_search (message_search, rowid, body, participants)
+        VALUES ('delete', OLD.id, OLD.content, OLD.sender || ' ' || OLD.peer);
+END;
+INSERT INTO message_search (rowid, body, participants)
+    SELECT id, content, sender || ' ' || peer FROM messages
+    WHERE type = 'text' AND NOT EXISTS (SELECT 1 FROM counters WHERE name = 'search_indexed');
+INSERT OR IGNORE INTO counters (name, value) VALUES ('search_indexed', 1);
+COMMIT;
+"""
+
+
+def fts_phrase(text):
+    """Quote text as an FTS5 phrase so it is matched literally"""
+    return '"' + text.replace('"', '""') + '"'
+
+
+# Messages at or below a conversation's tombstone are cleared and skipped by every read
+NOT_CLEARED = "id > IFNULL((SELECT max_id FROM tombstones WHERE conversation = ?), 0)"
+
+INSERT_MESSAGE = (
+    "INSERT INTO messages (conversation, sender, peer, type, content, time, timestamp, extra)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+# Shard inserts take the message time in milliseconds as rowid unless the shard is already past it
+INSERT_TIMED_MESSAGE = (
+    "INSERT INTO messages (id, conversation, sender, peer, type, content, time, timestamp, extra)"
+    " VALUES (MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0) + 1, ?),"
+    " ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def conversation_id(user_a, user_b):
+    """Text form of the conversation key, used as the SQLite column value"""
+    return "\x1f".join(conversation_key(user_a, user_b))
+
+
+class SqliteStore(ChatStore):
+    """Embedded SQLite database in WAL mode, one connection per thread.
+
+    Reads use the calling thread's connection. Writes from every session are
+    group-committed by one background writer: each batch is a single
+    transaction with one WAL sync. A clear writes one tombstone row; the
+    compactor deletes the cleared rows in chunks through the same writer.
+
+    As a shard of a ``ShardedStore``, message ids are exposed as
+    ``rowid * id_stride + id_offset`` so ids stay unique across shards and
+    still grow with every message stored in the shard. Shard rowids follow
+    the message time, so ids from different shards also sort by time.
+    """
+
+    def __init__(self, path, peer_key, blobs=None, events=None, id_stride=1, id_offset=0):
+        super().__init__(peer_key, blobs, events)
+        self.path = path
+        self.id_stride = id_stride
+        self.id_offset = id_offset
+        self.timed_ids = id_stride > 1
+        self.local = threading.local()
+        self._connect().executescript(SCHEMA + SEARCH_SCHEMA)
+        self.writer = GroupCommitWriter(self._flush_statements, name="sqlite-writer")
+        self.compactor = Compactor(self._compact_step, name="sqlite-compactor")
+
+    def _connect(self, synchronous="NORMAL"):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+            self.local.conn = conn
+        return conn
+
+    def _flush_statements(self, statements):
+        # Only the writer thread gets here; its connection syncs on every commit
+        conn = self._connect(synchronous="FULL")
+        results = []
+        with conn:
+            for sql, params in statements:
+                # A list of parameter tuples is a bulk statement
+                if isinstance(params, list):
+                    cursor = conn.executemany(sql, params)
+                else:
+                    cursor = conn.execute(sql, params)
+                results.append((cursor.rowcount, cursor.lastrowid))
+        return results
+
+    def _write(self, sql, params):
+        """Run a statement through the group-commit writer; return its row count and row id"""
+        return self.writer.write((sql, params))
+
+    def _message_id(self, rowid):
+        return rowid * self.id_stride + self.id_offset
+
+    def _rowids_after(self, message_id):
+        """Largest rowid whose message id is at most ``message_id``"""
+        return (message_id - self.id_offset) // self.id_stride
+
+    def _rowids_before(self, message_id):
+        """Smallest rowid whose message id is at least ``message_id``"""
+        return -((self.id_offset - message_id) // self.id_stride)
+
+    def _message_from_row(self, row):
+        message_id, msg_type, sender, peer, content, time, timestamp, extra = row
+        message = {
+            "id": self._message_id(message_id),
+            "type": msg_type,
+            "sender": sender,
+            self.peer_key: peer,
+            "content": content,
+            "time": time,
+            "timestamp": timestamp
+        }
+        if extra:
+            message.update(json.loads(extra))
+        return message
+
+    def get_user(self, username):
+        row = self._connect().execute(
+            "SELECT info FROM users WHERE username = ?", (username,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_user(self, username, info):
+        added = self._write(
+            "INSERT OR IGNORE INTO users (username, info) VALUES (?, ?)",
+            (username, json.dumps(info))
+        )[0] == 1
+        if added:
+            self._publish_user(username)
+        return added
+
+    def find_users(self, prefix="", limit=None, after=None):
+        # A range over the primary key index; no character sorts after U+10FFFF
+        query = "SELECT username FROM users WHERE username >= ? AND username < ?"
+        params = [prefix, prefix + "\U0010ffff"]
+        if after is not None:
+            query += " AND username > ?"
+            params.append(after)
+        query += " ORDER BY username"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return [row[0] for row in self._connect().execute(query, params)]
+
+    def _counter(self, name):
+        return self._connect().execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+    def user_count(self):
+        return self._counter("users")
+
+    def get_contacts(self, username):
+        rows = self._connect().execute(
+            "SELECT contact FROM contacts WHERE username = ? ORDER BY rowid", (username,)
+        )
+        return [row[0] for row in rows]
+
+    def add_contact(self, username, contact):
+        added = self._write(
+            "INSERT OR IGNORE INTO contacts (username, contact) VALUES (?, ?)",
+            (username, contact)
+        )[0] == 1
+        if added:
+            self._publish_contact(username)
+        return added
+
+    def _message_row(self, message):
+        peer = message[self.peer_key]
+        extra = {k: v for k, v in message.items() if k not in MESSAGE_FIELDS and k != self.peer_key}
+        row = (
+            conversation_id(message["sender"], peer), message["sender"], peer,
+            message["type"], message["content"], message["time"], message["timestamp"],
+            json.dumps(extra) if extra else None
+        )
+        if self.timed_ids:
+            row = ((parse_timestamp(message["timestamp"]) or 0) // 1000,) + row
+        return row
+
+    def _insert_message(self):
+        return INSERT_TIMED_MESSAGE if self.timed_ids else INSERT_MESSAGE
+
+    def add_message(self, message):
+        rowid = self._write(self._insert_message(), self._message_row(message))[1]
+        self._publish_conversation(message["sender"], message[self.peer_key])
+        return self._message_id(rowid)
+
+    def get_conversation(self, user_a, user_b, limit=None, before=None):
+        conversation = conversation_id(user_a, user_b)
+        query = (
+            "SELECT id, type, sender, peer, content, time, timestamp, extra FROM messages"
+            f" WHERE conversation = ? AND {NOT_CLEARED}"
+        )
+        params = [conversation, conversation]
+        if before is not None:
+            query += " AND (timestamp, id) < (?, ?)"
+            params.extend((before[0], self._rowids_before(before[1])))
+        # Walk the index backwards from the cursor so only the page is read
+        query += " ORDER BY timestamp DESC, id DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with metrics.span("store.get_conversation"):
+            rows = self._connect().execute(query, params).fetchall()
+        metrics.count("store.messages_scanned", len(rows))
+        return [self._message_from_row(row) for row in reversed(rows)]
+
+    def get_messages_since(self, user_a, user_b, after_id):
+        with metrics.span("store.get_messages_since"):
+            rows = self._connect().execute(
+                "SELECT id, type, sender, peer, content, time, timestamp, extra FROM messages"
+                f" WHERE conversation = ? AND id > ? AND {NOT_CLEARED} ORDER BY id",
+                (conversation_id(user_a, user_b), self._rowids_after(after_id), conversation_id(user_a, user_b))
+            ).fetchall()
+        metrics.count("store.messages_scanned", len(rows))
+        return [self._message_from_row(row) for row in rows]
+
+    def clear_conversation(self, user_a, user_b):
+        conversation = conversation_id(user_a, user_b)
+        # Covers every stored message of the conversation; one index lookup, no deletes yet
+        self._write(
+            "INSERT OR REPLACE INTO tombstones (conversation, max_id, pending)"
+            " SELECT ?, IFNULL(MAX(id), 0), 1 FROM messages WHERE conversation = ?",
+            (conversation, conversation)
+        )
+        self._publish_conversation(user_a, user_b)
+        self.compactor.wake()
+
+    def _compact_step(self):
+        """Delete one chunk of cleared rows of a conversation with pending tombstones"""
+        row = self._connect().execute(
+            "SELECT conversation, max_id FROM tombstones WHERE pending = 1 LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return False
+        conversation, max_id = row
+        deleted = self._write(
+            "DELETE FROM messages WHERE id IN"
+            " (SELECT id FROM messages WHERE conversation = ? AND id <= ? LIMIT ?)",
+            (conversation, max_id, COMPACTION_CHUNK)
+        )[0]
+        if deleted < COMPACTION_CHUNK:
+            # Done, unless the chat was cleared again meanwhile with a newer tombstone
+            self._write(
+                "UPDATE tombstones SET pending = 0 WHERE conversation = ? AND max_id = ?",
+                (conversation, max_id)
+            )
+        return True
+
+    def import_data(self, users=(), contacts=(), messages=()):
+        users, contacts, messages = list(users), list(contacts), list(messages)
+        statements = [
+            ("INSERT OR IGNORE INTO users (username, info) VALUES (?, ?)",
+             [(username, json.dumps(info)) for username, info in users]),
+            ("INSERT OR IGNORE INTO contacts (username, contact) VALUES (?, ?)", list(contacts)),
+            (self._insert_message(), [self._message_row(message) for message in messages])
+        ]
+        # One writer item per table: each is a single executemany in the group transaction
+        for future in [self.writer.submit(statement) for statement in statements]:
+            future.result()
+        self._publish_import(users, contacts, messages)
+
+    def search_messages(self, username, query, contact=None, limit=None, before=None):
+        terms = query_terms(query)
+        if not terms:
+            return []
+        clauses = [f"body : {fts_phrase(term)}" for term in terms]
+        if tokenize(username):
+            # Narrows the match to the user's messages inside the index; the join checks exact names
+            clauses.append(f"participants : {fts_phrase(username)}")
+        query = (
+            "SELECT m.id, m.type, m.sender, m.peer, m.content, m.time, m.timestamp, m.extra"
+            " FROM message_search AS s JOIN messages AS m ON m.id = s.rowid"
+            " WHERE message_search MATCH ? AND (m.sender = ? OR m.peer = ?)"
+            " AND m.id > IFNULL((SELECT max_id FROM tombstones WHERE conversation = m.conversation), 0)"
+        )
+        params = [" AND ".join(clauses), username, username]
+        if contact is not None:
+            query += " AND m.conversation = ?"
+            params.append(conversation_id(username, contact))
+        if before is not None:
+            query += " AND s.rowid < ?"
+            params.append(self._rowids_before(before))
+        # The index returns rowids newest first, so only the page is read
+        query += " ORDER BY s.rowid DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with metrics.span("store.search"):
+            rows = self._connect().execute(query, params).fetchall()
+        metrics.count("store.search_results", len(rows))
+        return [self._message_from_row(row) for row in rows]
+
+    def message_count(self):
+        return self._counter("messages")
+
+    def conversation_message_count(self, user_a, user_b):
+        row = self._connect().execute(
+            "SELECT messages FROM conversation_counts WHERE conversation = ?",
+            (conversation_id(user_a, user_b),)
+        ).fetchone()
+        return row[0] if row else 0
+
+
+class ShardedStore(ChatStore):
+    """Users and contacts in one SQLite file, messages in ``shards`` SQLite shard files.
+
+    Each conversation lives in the shard its user pair hashes to, next to
+    ``path`` as ``<name>.shard<N><ext>``. Every shard has its own writer,
+    WAL and write lock, so sends to different conversations commit in
+    parallel within a process and across processes sharing the directory.
+    All parts publish on this store's event bus.
+    """
+
+    def __init__(self, path, peer_key, blobs=None, shards=SHARD_COUNT):
+        super().__init__(peer_key, blobs)
+        self.directory = SqliteStore(path, peer_key, blobs, self.events)
+        self._check_shard_count(shards)
+        name, ext = os.path.splitext(path)
+        self.shards = [
+            SqliteStore(f"{name}.shard{index}{ext}", peer_key, blobs, self.events, id_stride=shards, id_offset=index)
+            for index in range(shards)
+        ]
+
+    def _check_shard_count(self, shards):
+        # Conversations are placed by hash, so reopening with another count would lose them
+        self.directory._write("INSERT OR IGNORE INTO counters (name, value) VALUES ('shards', ?)", (shards,))
+        stored = self.directory._counter("shards")
+        if stored != shards:
+            raise ValueError(f"{self.directory.path} was created with {stored} shards, not {shards}")
+
+    def _shard_index(self, user_a, user_b):
+        # crc32 rather than hash(): every process must pick the same shard
+        return zlib.crc32(conversation_id(user_a, user_b).encode("utf-8")) % len(self.shards)
+
+    def _shard(self, user_a, user_b):
+        return self.shards[self._shard_index(user_a, user_b)]
+
+    def get_user(self, username):
+        return self.directory.get_user(username)
+
+    def add_user(self, username, info):
+        return self.directory.add_user(username, info)
+
+    def find_users(self, prefix="", limit=None, after=None):
+        return self.directory.find_users(prefix, limit, after)
+
+    def user_count(self):
+        return self.directory.user_count()
+
+    def get_contacts(self, username):
+        return self.directory.get_contacts(username)
+
+    def add_contact(self, username, contact):
+        return self.directory.add_contact(username, contact)
+
+    def add_message(self, message):
+        return self._shard(message["sender"], message[self.peer_key]).add_message(message)
+
+    def get_conversation(self, user_a, user_b, limit=None, before=None):
+        return self._shard(user_a, user_b).get_conversation(user_a, user_b, limit, before)
+
+    def get_messages_since(self, user_a, user_b, after_id):
+        return self._shard(user_a, user_b).get_messages_since(user_a, user_b, after_id)
+
+    def clear_conversation(self, user_a, user_b):
+        self._shard(user_a, user_b).clear_conversation(user_a, user_b)
+
+    def search_messages(self, username, query, contact=None, limit=None, before=None):
+        if contact is not None:
+            return self._shard(username, contact).search_messages(username, query, contact, limit, before)
+        # Each shard returns its newest hits; ids follow message time across shards, so merge by id
+        pages = [shard.search_messages(username, query, None, limit, before) for shard in self.shards]
+        hits = heapq.merge(*pages, key=lambda message: message["id"], reverse=True)
+        return list(itertools.islice(hits, limit))
+
+    def message_count(self):
+        return sum(shard.message_count() for shard in self.shards)
+
+    def conversation_message_count(self, user_a, user_b):
+        return self._shard(user_a, user_b).conversation_message_count(user_a, user_b)
+
+    def import_data(self, users=(), contacts=(), messages=()):
+        self.directory.import_data(users, contacts)
+        by_shard = {}
+        for message in messages:
+            by_shard.setdefault(self._shard_index(message["sender"], message[self.peer_key]), []).append(message)
+        for index, shard_messages in sorted(by_shard.items()):
+            self.shards[index].import_data(messages=shard_messages)
+
+
+def open_store(backend, peer_key, json_path, log_path, sqlite_path, blobs=None, time_format=None,
+               archive_after_days=None):
+    """Create the storage engine selected by ``backend`` ("json", "sqlite" or "sharded").
+
+    ``time_format`` is the strftime format of the apps' display ``time``;
+    the JSON store derives that field from the timestamp when it matches.
+    With ``archive_after_days``, the JSON store archives chats idle that long;
+    the SQLite stores only ever read the pages a query needs, so they keep everything.
+    """
+    if backend == "sqlite":
+        return SqliteStore(sqlite_path, peer_key, blobs)
+    if backend == "sharded":
+        # The SQLite file holds users and contacts; message shards sit next to it
+        return ShardedStore(sqlite_path, peer_key, blobs)
+    if backend == "json":
+        archive_after = datetime.timedelta(days=archive_after_days) if archive_after_days else None
+        return JsonLogStore(json_path, log_path, peer_key, blobs, time_format=time_format, archive_after=archive_after)
+    raise ValueError(f"Unknown storage backend: {backend}")
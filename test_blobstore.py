@@ -0,0 +1,47 @@
+# test_blobstore.py
+"""Content-addressed blob storage."""
+import base64
+import hashlib
+import os
+
+import pytest
+
+from blobstore import BlobStore
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"), url_prefix="app/static/blobs")
+
+
+def test_put_names_blobs_by_content(blobs):
+    blob_id = blobs.put(b"picture bytes", "PNG")
+    assert blob_id == f"{hashlib.sha256(b'picture bytes').hexdigest()}.png"
+    with open(blobs.path(blob_id), "rb") as f:
+        assert f.read() == b"picture bytes"
+    assert blobs.url(blob_id) == f"app/static/blobs/{blob_id[:2]}/{blob_id}"
+
+
+def test_storing_the_same_content_again_is_a_no_op(blobs):
+    first = blobs.put(b"same", "jpg")
+    mtime = os.stat(blobs.path(first)).st_mtime_ns
+    assert blobs.put(b"same", "jpg") == first
+    assert os.stat(blobs.path(first)).st_mtime_ns == mtime
+    # No temporary files are left next to the blob
+    assert os.listdir(os.path.dirname(blobs.path(first))) == [first]
+
+
+def test_put_data_uri_decodes_inline_images(blobs):
+    payload = base64.b64encode(b"gif bytes").decode()
+    blob_id = blobs.put_data_uri(f"data:image/gif;base64,{payload}")
+    assert blob_id.endswith(".gif")
+    with open(blobs.path(blob_id), "rb") as f:
+        assert f.read() == b"gif bytes"
+    # Unknown types still get a usable extension
+    assert blobs.put_data_uri(f"data:application/x-unknown;base64,{payload}").endswith(".bin")
+
+
+@pytest.mark.parametrize("blob_id", ["../../etc/passwd", "abc.png", "0" * 64, "0" * 64 + ".PNG/x"])
+def test_invalid_blob_ids_are_rejected(blobs, blob_id):
+    with pytest.raises(ValueError):
+        blobs.path(blob_id)
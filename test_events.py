@@ -0,0 +1,52 @@
+# test_events.py
+"""Change notifications: the bus itself and what each store write publishes."""
+import pytest
+
+from events import USERS_TOPIC, EventBus, conversation_topic, user_topic
+from test_storage import BACKENDS, make_message, open_test_store
+
+
+def test_subscription_polls_true_once_per_change():
+    bus = EventBus()
+    subscription = bus.subscribe(user_topic("alice"), conversation_topic("bob", "alice"))
+    assert not subscription.poll()
+    bus.publish(user_topic("carol"))
+    assert not subscription.poll()
+    bus.publish(conversation_topic("alice", "bob"))
+    assert subscription.poll()
+    assert not subscription.poll()
+    # Several publishes between polls are reported once
+    bus.publish(user_topic("alice"))
+    bus.publish(user_topic("alice"))
+    assert subscription.poll()
+    assert not subscription.poll()
+
+
+def test_new_subscriptions_start_from_the_current_version():
+    bus = EventBus()
+    bus.publish(USERS_TOPIC)
+    assert not bus.subscribe(USERS_TOPIC).poll()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_store_writes_publish_their_topics(tmp_path, backend):
+    store = open_test_store(backend, tmp_path)
+    directory = store.events.subscribe(USERS_TOPIC)
+    alice = store.events.subscribe(user_topic("alice"))
+    chat = store.events.subscribe(conversation_topic("alice", "bob"))
+    other_chat = store.events.subscribe(conversation_topic("alice", "carol"))
+
+    store.add_user("alice", {})
+    assert directory.poll()
+    assert not store.add_user("alice", {})
+    assert not directory.poll()
+
+    store.add_contact("alice", "bob")
+    assert alice.poll() and not chat.poll()
+
+    store.add_message(make_message("bob", "alice", "hello", 0))
+    assert chat.poll() and alice.poll()
+    assert not other_chat.poll()
+
+    store.clear_conversation("alice", "bob")
+    assert chat.poll() and alice.poll()
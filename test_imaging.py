@@ -0,0 +1,83 @@
+# test_imaging.py
+"""Upload processing: what is kept as uploaded, what is re-encoded, and thumbnails."""
+import io
+
+import pytest
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from blobstore import BlobStore
+from imaging import MAX_DIMENSION, THUMBNAIL_SIZE, process_image
+
+# EXIF tags written into the test uploads
+ORIENTATION = 0x0112
+MAKE = 0x010F
+GPS_INFO = 0x8825
+
+
+@pytest.fixture
+def blobs(tmp_path):
+    return BlobStore(str(tmp_path / "blobs"))
+
+
+def encode(size, image_format="JPEG", exif=None):
+    buffered = io.BytesIO()
+    image = Image.new("RGB", size, "red")
+    if exif is not None:
+        image.save(buffered, format=image_format, exif=exif)
+    else:
+        image.save(buffered, format=image_format)
+    return buffered.getvalue()
+
+
+def read_blob(blobs, blob_id):
+    with open(blobs.path(blob_id), "rb") as f:
+        return f.read()
+
+
+def open_blob(blobs, blob_id):
+    return Image.open(io.BytesIO(read_blob(blobs, blob_id)))
+
+
+def test_clean_upload_is_kept_byte_for_byte(blobs):
+    data = encode((400, 300))
+    full_id, thumbnail_id = process_image(data, blobs)
+    assert full_id.endswith(".jpg")
+    assert read_blob(blobs, full_id) == data
+    with open_blob(blobs, thumbnail_id) as thumbnail:
+        assert max(thumbnail.size) <= max(THUMBNAIL_SIZE)
+
+
+@pytest.mark.parametrize("image_format", ["JPEG", "PNG", "WEBP"])
+def test_exif_is_stripped_and_orientation_applied(blobs, image_format):
+    exif = Image.Exif()
+    exif[MAKE] = "Test Camera"
+    exif[ORIENTATION] = 6
+    exif[GPS_INFO] = {1: "N", 2: (52.0, 31.0, 12.0)}
+    data = encode((400, 300), image_format, exif.tobytes())
+    full_id, thumbnail_id = process_image(data, blobs)
+    assert read_blob(blobs, full_id) != data
+    for blob_id in (full_id, thumbnail_id):
+        with open_blob(blobs, blob_id) as stored:
+            assert not stored.getexif()
+            assert b"Test Camera" not in read_blob(blobs, blob_id)
+    with open_blob(blobs, full_id) as full:
+        # Orientation 6 turns the landscape upload into portrait
+        assert full.size == (300, 400)
+
+
+def test_png_text_chunks_are_stripped(blobs):
+    info = PngInfo()
+    info.add_text("Location", "52.52 N 13.40 E")
+    buffered = io.BytesIO()
+    Image.new("RGB", (50, 50), "blue").save(buffered, format="PNG", pnginfo=info)
+    full_id, _ = process_image(buffered.getvalue(), blobs)
+    assert b"52.52" not in read_blob(blobs, full_id)
+
+
+def test_oversized_upload_is_downscaled(blobs):
+    data = encode((MAX_DIMENSION * 2, 100), "PNG")
+    full_id, _ = process_image(data, blobs)
+    assert full_id.endswith(".png")
+    with open_blob(blobs, full_id) as full:
+        assert full.size == (MAX_DIMENSION, 50)
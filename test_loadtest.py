@@ -0,0 +1,30 @@
+# test_loadtest.py
+"""The load test harness itself: a short multi-process run must verify clean."""
+import json
+
+import pytest
+
+import loadtest
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_short_run_verifies_every_acknowledged_write(tmp_path, backend):
+    output = tmp_path / "load.json"
+    argv = [
+        "--backend", backend, "--processes", "2", "--sessions", "3", "--actions", "20",
+        "--dir", str(tmp_path / "data"), "--output", str(output)
+    ]
+    assert loadtest.main(argv) == 0
+    (row,) = json.loads(output.read_text())
+    assert row["acked_messages"] > 0
+    assert row["double_registrations"] == []
+    assert row["operations"]["register"]["count"] >= 6 * (1 + loadtest.SHARED_NAMES)
+
+
+def test_verify_claims_reports_names_acknowledged_twice(tmp_path):
+    store = loadtest.open_load_store("app", "json", str(tmp_path))
+    store.add_user("lt-shared-0", {"owner": "a"})
+    store.add_user("lt-shared-1", {"owner": "b"})
+    claims = [("lt-shared-0", "a"), ("lt-shared-1", "a"), ("lt-shared-2", "c"), ("lt-shared-2", "d")]
+    # shared-1 is stored for another session, shared-2 was acknowledged twice and never stored
+    assert loadtest.verify_claims(store, claims) == ["lt-shared-1", "lt-shared-2"]
@@ -0,0 +1,124 @@
+# test_migrate.py
+"""Streaming conversion between the two apps' chat files and into the storage backends."""
+import base64
+import io
+import json
+import os
+
+import pytest
+
+import migrate
+from blobstore import BlobStore
+from storage import APP_SCHEMAS, open_store
+
+PIXEL = base64.b64encode(b"not really a gif").decode()
+
+TEXTBOX_DATA = {
+    "users": {
+        "alice": {"password": "a", "contacts": ["bob"]},
+        "bob": {"password": "b", "contacts": ["alice", "carol"]}
+    },
+    "messages": [
+        {"type": "text", "sender": "alice", "contact": "bob", "content": 'hi \u00e9 "bob"',
+         "time": "13:05", "timestamp": "2024-03-01T13:05:00"},
+        {"type": "image", "sender": "bob", "contact": "alice", "content": f"data:image/gif;base64,{PIXEL}",
+         "time": "13:06", "timestamp": "2024-03-01T13:06:00"}
+    ]
+}
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "chat_data.json"
+    path.write_text(json.dumps(TEXTBOX_DATA))
+    return path
+
+
+def open_target(backend, directory, schema):
+    config = APP_SCHEMAS[schema]
+    return open_store(
+        backend, config["peer_key"], str(directory / config["json"]), str(directory / config["log"]),
+        str(directory / config["sqlite"]), time_format=config["time_format"]
+    )
+
+
+def test_file_to_file_converts_layout(tmp_path, source, monkeypatch):
+    # Tiny reads make every value straddle buffer refills
+    monkeypatch.setattr(migrate, "READ_CHUNK", 7)
+    target = tmp_path / "chat_database.json"
+    assert migrate.main([str(source), "--to", "app", "--output", str(target), "--quiet"]) == 0
+    data = json.loads(target.read_text())
+    assert data["users"] == {"alice": {"password": "a"}, "bob": {"password": "b"}}
+    assert data["contacts"] == {"alice": ["bob"], "bob": ["alice", "carol"]}
+    first, second = data["messages"]
+    assert first["receiver"] == "bob" and "contact" not in first
+    assert first["content"] == TEXTBOX_DATA["messages"][0]["content"]
+    assert first["time"] == "01:05 PM"
+    assert second["content"].startswith("data:image/gif")
+
+
+def test_file_round_trip_keeps_everything(tmp_path, source):
+    app_file = tmp_path / "chat_database.json"
+    back = tmp_path / "back.json"
+    migrate.main([str(source), "--to", "app", "--output", str(app_file), "--quiet"])
+    migrate.main([str(app_file), "--to", "textbox", "--output", str(back), "--quiet"])
+    assert json.loads(back.read_text()) == TEXTBOX_DATA
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite", "sharded"])
+def test_import_into_a_store_moves_images_to_blobs(tmp_path, source, backend):
+    output = tmp_path / "data"
+    blob_dir = tmp_path / "blobs"
+    migrate.main([
+        str(source), "--to", "app", "--backend", backend, "--output", str(output),
+        "--blob-dir", str(blob_dir), "--quiet"
+    ])
+    store = open_target(backend, output, "app")
+    assert store.get_user("bob") == {"password": "b"}
+    assert store.get_contacts("bob") == ["alice", "carol"]
+    assert store.message_count() == 2
+    text, image = store.get_conversation("alice", "bob")
+    assert text["receiver"] == "bob" and text["time"] == "01:05 PM"
+    with open(BlobStore(str(blob_dir)).path(image["content"]), "rb") as f:
+        assert f.read() == b"not really a gif"
+
+
+def test_json_import_next_to_its_own_base_file_is_refused(tmp_path, source, monkeypatch):
+    # Run from the data directory, where chat_data.json is also the textbox JSON store's base file
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(SystemExit) as exit_info:
+        migrate.main(["chat_data.json", "--to", "textbox", "--backend", "json", "--quiet"])
+    assert exit_info.value.code == 2
+    assert not os.path.exists(tmp_path / "chat_data.log")
+    assert open_target("json", tmp_path, "textbox").message_count() == 2
+
+
+def test_json_import_from_the_data_directory_into_the_other_layout(tmp_path, source, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert migrate.main(["chat_data.json", "--to", "app", "--backend", "json", "--quiet"]) == 0
+    store = open_target("json", tmp_path, "app")
+    assert store.message_count() == 2
+    assert store.get_contacts("alice") == ["bob"]
+
+
+def test_migrate_batches_messages(tmp_path):
+    data = {"messages": [
+        {"type": "text", "sender": "a", "receiver": "b", "content": str(index), "time": "x",
+         "timestamp": f"2024-03-01T10:{index:02d}:00"}
+        for index in range(25)
+    ], "users": {}, "contacts": {}}
+    batches = []
+
+    class Sink:
+        def add_messages(self, messages):
+            batches.append(len(messages))
+
+        def close(self, users, contacts):
+            pass
+
+        def abort(self):
+            pass
+
+    source = io.BytesIO(json.dumps(data).encode("utf-8"))
+    assert migrate.migrate(source, Sink(), "app", batch_size=10) == (0, 25)
+    assert batches == [10, 10, 5]
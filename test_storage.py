@@ -0,0 +1,416 @@
+# test_storage.py
+"""Behaviour shared by every storage backend, plus backend-specific features.
+
+Run with ``python -m pytest -q`` from the repository root.
+"""
+import datetime
+import os
+import threading
+import time
+
+import pytest
+
+from chatlog import message_cursor
+from storage import JsonLogStore, ShardedStore, open_store
+
+BACKENDS = ("json", "sqlite", "sharded")
+
+# Timestamps of the seeded messages start here, one minute apart
+START = datetime.datetime.now() - datetime.timedelta(days=1)
+
+
+def open_test_store(backend, directory):
+    return open_store(
+        backend, "receiver", str(directory / "chat.json"), str(directory / "chat.log"),
+        str(directory / "chat.sqlite3"), time_format="%I:%M %p"
+    )
+
+
+def make_message(sender, receiver, content, minute, start=START):
+    moment = start + datetime.timedelta(minutes=minute)
+    return {
+        "type": "text",
+        "sender": sender,
+        "receiver": receiver,
+        "content": content,
+        "time": moment.strftime("%I:%M %p"),
+        "timestamp": moment.isoformat()
+    }
+
+
+def add_messages(store, sender, receiver, count, first_minute=0, start=START):
+    """Store ``count`` messages alternating between both users; return their ids"""
+    ids = []
+    for index in range(count):
+        users = (sender, receiver) if index % 2 == 0 else (receiver, sender)
+        ids.append(store.add_message(make_message(*users, f"note {index} pelican", first_minute + index, start)))
+    return ids
+
+
+@pytest.fixture(params=BACKENDS)
+def store(request, tmp_path):
+    return open_test_store(request.param, tmp_path)
+
+
+def test_users_contacts_and_messages_round_trip(store):
+    assert store.add_user("alice", {"password": "x"})
+    assert not store.add_user("alice", {"password": "y"})
+    assert store.get_user("alice") == {"password": "x"}
+    assert store.get_user("nobody") is None
+    assert store.user_count() == 1
+
+    assert store.add_contact("alice", "bob")
+    assert store.add_contact("alice", "carol")
+    assert not store.add_contact("alice", "bob")
+    assert store.get_contacts("alice") == ["bob", "carol"]
+    assert store.get_contacts("bob") == []
+
+    sent = make_message("alice", "bob", "hi there", 0)
+    message_id = store.add_message(dict(sent))
+    stored = store.get_conversation("bob", "alice")
+    assert stored == [dict(sent, id=message_id)]
+    assert store.get_conversation("alice", "carol") == []
+    assert store.message_count() == 1
+    assert store.conversation_message_count("alice", "bob") == 1
+
+
+def test_import_data_stores_everything_once(store):
+    messages = [make_message("alice", "bob", f"imported {index}", index) for index in range(5)]
+    store.import_data(users=[("alice", {}), ("bob", {})], contacts=[("alice", "bob")], messages=messages)
+    assert store.user_count() == 2
+    assert store.get_contacts("alice") == ["bob"]
+    assert [m["content"] for m in store.get_conversation("alice", "bob")] == [f"imported {index}" for index in range(5)]
+    assert store.message_count() == 5
+
+
+def test_conversation_pages_walk_back_with_cursor(store):
+    add_messages(store, "alice", "bob", 25)
+    add_messages(store, "alice", "carol", 5, first_minute=100)
+    everything = store.get_conversation("alice", "bob")
+    assert [m["content"] for m in everything] == [f"note {index} pelican" for index in range(25)]
+
+    pages = []
+    page = store.get_conversation("alice", "bob", limit=10)
+    while page:
+        pages.append(page)
+        page = store.get_conversation("alice", "bob", limit=10, before=message_cursor(page[0]))
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert [m for page in reversed(pages) for m in page] == everything
+
+
+def test_conversation_pages_follow_timestamps_not_arrival(store):
+    # A message stamped earlier but stored later still pages into its place
+    store.add_message(make_message("alice", "bob", "second", 2))
+    store.add_message(make_message("bob", "alice", "third", 3))
+    store.add_message(make_message("alice", "bob", "first", 1))
+    page = store.get_conversation("alice", "bob", limit=2)
+    assert [m["content"] for m in page] == ["second", "third"]
+    older = store.get_conversation("alice", "bob", limit=2, before=message_cursor(page[0]))
+    assert [m["content"] for m in older] == ["first"]
+
+
+def test_find_users_by_prefix_in_pages(store):
+    names = ["carol", "alice", "Alex", "alan", "bob", "al", "albert", "alfred", "\u00e1lvaro"]
+    store.import_data(users=[(name, {}) for name in names[:4]])
+    for name in names[4:]:
+        store.add_user(name, {})
+    assert store.find_users() == sorted(names)
+    assert store.find_users("al") == ["al", "alan", "albert", "alfred", "alice"]
+    assert store.find_users("Al") == ["Alex"]
+    assert store.find_users("zed") == []
+
+    pages = []
+    page = store.find_users("al", limit=2)
+    while page:
+        pages.append(page)
+        page = store.find_users("al", limit=2, after=page[-1])
+    assert pages == [["al", "alan"], ["albert", "alfred"], ["alice"]]
+    # A cursor before or past the prefix range starts at its edge
+    assert store.find_users("b", after="alice") == ["bob"]
+    assert store.find_users("a", after="bob") == []
+
+
+def run_concurrently(count, action):
+    """Run ``action(index)`` on ``count`` threads started together; return the results"""
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        results[index] = action(index)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_duplicate_registrations_succeed_once(store):
+    results = run_concurrently(8, lambda index: store.add_user("dup", {"password": str(index)}))
+    assert results.count(True) == 1
+    assert store.user_count() == 1
+    assert store.get_user("dup") == {"password": str(results.index(True))}
+
+    results = run_concurrently(8, lambda index: store.add_contact("dup", "friend"))
+    assert results.count(True) == 1
+    assert store.get_contacts("dup") == ["friend"]
+
+
+def test_json_registrations_race_across_processes(tmp_path):
+    # Two stores on the same files stand in for two processes sharing the log
+    stores = [open_test_store("json", tmp_path), open_test_store("json", tmp_path)]
+    results = run_concurrently(8, lambda index: stores[index % 2].add_user("dup", {}))
+    assert results.count(True) == 1
+    assert open_test_store("json", tmp_path).user_count() == 1
+
+
+def test_messages_since_returns_only_newer_messages(store):
+    ids = add_messages(store, "alice", "bob", 6)
+    assert ids == sorted(ids)
+    assert [m["id"] for m in store.get_messages_since("alice", "bob", 0)] == ids
+    assert [m["id"] for m in store.get_messages_since("bob", "alice", ids[3])] == ids[4:]
+    assert store.get_messages_since("alice", "bob", ids[-1]) == []
+
+    # Messages in other chats do not show up
+    add_messages(store, "alice", "carol", 2, first_minute=10)
+    assert store.get_messages_since("alice", "bob", ids[-1]) == []
+    new_id = store.add_message(make_message("bob", "alice", "late", 20))
+    assert [m["id"] for m in store.get_messages_since("alice", "bob", ids[-1])] == [new_id]
+
+
+def wait_compacted(store, timeout=10):
+    """Wait until the background compactor has reclaimed every cleared message"""
+    deadline = time.monotonic() + timeout
+    while not compacted(store):
+        assert time.monotonic() < deadline, "compaction did not finish"
+        time.sleep(0.01)
+
+
+def compacted(store):
+    if isinstance(store, JsonLogStore):
+        state = store.cache.get()
+        return not state["hidden"] and not state["search_stale"]
+    shards = store.shards if isinstance(store, ShardedStore) else [store]
+    return all(
+        shard._connect().execute("SELECT COUNT(*) FROM tombstones WHERE pending = 1").fetchone()[0] == 0
+        for shard in shards
+    )
+
+
+def test_clear_updates_counts_before_and_after_compaction(store):
+    add_messages(store, "alice", "bob", 12)
+    add_messages(store, "alice", "carol", 4, first_minute=20)
+    assert store.message_count() == 16
+
+    store.clear_conversation("bob", "alice")
+    # Reads and counts skip the cleared messages before any space is reclaimed
+    assert store.get_conversation("alice", "bob") == []
+    assert store.get_messages_since("alice", "bob", 0) == []
+    assert store.conversation_message_count("alice", "bob") == 0
+    assert store.message_count() == 4
+
+    wait_compacted(store)
+    assert store.message_count() == 4
+    assert store.conversation_message_count("alice", "carol") == 4
+
+    new_id = store.add_message(make_message("alice", "bob", "fresh start", 40))
+    assert [m["id"] for m in store.get_conversation("alice", "bob")] == [new_id]
+    assert store.conversation_message_count("alice", "bob") == 1
+    assert store.message_count() == 5
+
+    # Clearing again covers the new message; compaction leaves the counts alone
+    store.clear_conversation("alice", "bob")
+    wait_compacted(store)
+    assert store.conversation_message_count("alice", "bob") == 0
+    assert store.message_count() == 4
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_counters_survive_reopening(tmp_path, backend):
+    store = open_test_store(backend, tmp_path)
+    store.import_data(users=[("alice", {}), ("bob", {})], messages=[
+        make_message("alice", "bob", f"imported {index}", index) for index in range(4)
+    ])
+    store.add_user("carol", {})
+    add_messages(store, "alice", "carol", 3, first_minute=10)
+    store.clear_conversation("alice", "carol")
+    store.add_message(make_message("carol", "alice", "again", 20))
+
+    reopened = open_test_store(backend, tmp_path)
+    assert reopened.user_count() == 3
+    assert reopened.message_count() == 5
+    assert reopened.conversation_message_count("bob", "alice") == 4
+    assert reopened.conversation_message_count("alice", "carol") == 1
+    assert reopened.conversation_message_count("bob", "carol") == 0
+
+
+def test_json_snapshot_restart_keeps_state_and_ids(tmp_path):
+    store = open_test_store("json", tmp_path)
+    store.add_user("alice", {"password": "x"})
+    store.add_contact("alice", "bob")
+    ids = add_messages(store, "alice", "bob", 10)
+    store.clear_conversation("alice", "carol")
+    store.checkpoint()
+    # Written after the snapshot, so the restart replays it from the log
+    late_id = store.add_message(make_message("bob", "alice", "after snapshot", 30))
+
+    reopened = open_test_store("json", tmp_path)
+    assert reopened.get_user("alice") == {"password": "x"}
+    # State is loaded on first use, from the snapshot rather than the whole log
+    assert reopened.snapshot_offset > 0
+    assert reopened.get_contacts("alice") == ["bob"]
+    assert reopened.get_conversation("alice", "bob") == store.get_conversation("alice", "bob")
+    assert [m["id"] for m in reopened.get_messages_since("alice", "bob", 0)] == ids + [late_id]
+    assert reopened.add_message(make_message("alice", "bob", "next", 31)) > late_id
+
+
+def test_json_checkpoint_without_a_log_file(tmp_path):
+    store = open_test_store("json", tmp_path)
+    store.add_user("alice", {})
+    store.checkpoint()
+    assert store.snapshot_offset > 0
+    # A missing log invalidates the snapshot; a forced checkpoint starts a new one
+    os.remove(tmp_path / "chat.log")
+    store.checkpoint()
+    assert os.path.exists(tmp_path / "chat.log")
+
+
+def test_search_pages_newest_first_and_filters_by_contact(store):
+    bob_ids = add_messages(store, "alice", "bob", 7)
+    carol_ids = add_messages(store, "alice", "carol", 3, first_minute=20)
+    store.add_message(make_message("bob", "carol", "pelican elsewhere", 30))
+    newest_first = (bob_ids + carol_ids)[::-1]
+
+    assert [m["id"] for m in store.search_messages("alice", "Pelican")] == newest_first
+    assert store.search_messages("alice", "pelican note 3")[0]["content"] == "note 3 pelican"
+    assert store.search_messages("alice", "albatross") == []
+    assert store.search_messages("alice", "  ") == []
+
+    pages = []
+    page = store.search_messages("alice", "pelican", limit=4)
+    while page:
+        pages.append([m["id"] for m in page])
+        page = store.search_messages("alice", "pelican", limit=4, before=page[-1]["id"])
+    assert pages == [newest_first[:4], newest_first[4:8], newest_first[8:]]
+
+    assert [m["id"] for m in store.search_messages("alice", "pelican", contact="carol")] == carol_ids[::-1]
+    assert [m["content"] for m in store.search_messages("carol", "pelican", contact="bob")] == ["pelican elsewhere"]
+
+    # Cleared chats drop out of the results at once
+    store.clear_conversation("alice", "bob")
+    assert [m["id"] for m in store.search_messages("alice", "pelican")] == carol_ids[::-1]
+    wait_compacted(store)
+    assert [m["id"] for m in store.search_messages("alice", "pelican")] == carol_ids[::-1]
+
+
+def test_sharded_search_merges_shards_newest_first(tmp_path):
+    store = ShardedStore(str(tmp_path / "chat.sqlite3"), "receiver", shards=4)
+    contacts = [f"friend{index}" for index in range(8)]
+    assert len({store._shard_index("alice", contact) for contact in contacts}) > 1
+    # Sends alternate between conversations, so consecutive messages land in different shards
+    sent = [
+        store.add_message(make_message("alice", contacts[index % len(contacts)], f"pelican {index}", index))
+        for index in range(24)
+    ]
+    newest_first = sent[::-1]
+    assert [m["id"] for m in store.search_messages("alice", "pelican")] == newest_first
+
+    pages = []
+    page = store.search_messages("alice", "pelican", limit=5)
+    while page:
+        pages.append([m["id"] for m in page])
+        page = store.search_messages("alice", "pelican", limit=5, before=page[-1]["id"])
+    assert [message_id for page in pages for message_id in page] == newest_first
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 4]
+
+
+def archived_segments(tmp_path):
+    directory = tmp_path / "chat.archive"
+    return sorted(os.listdir(directory)) if directory.exists() else []
+
+
+def test_json_archive_keeps_chats_written_during_the_segment_write(tmp_path):
+    store = open_test_store("json", tmp_path)
+    cold_start = datetime.datetime.now() - datetime.timedelta(days=200)
+    for contact in ("bob", "carol", "dave"):
+        add_messages(store, "alice", contact, 4, start=cold_start)
+    write = store.archive.write
+
+    def racing_write(name, conversations):
+        # Lands after the cold chats were picked and before the archive record is logged
+        store.add_message(make_message("bob", "alice", "still here", 0, datetime.datetime.now()))
+        store.clear_conversation("alice", "carol")
+        return write(name, conversations)
+
+    store.archive.write = racing_write
+    assert store.archive_cold(datetime.timedelta(days=90)) == 4
+    state = store.cache.get()
+    assert list(state["archived"]) == [("alice", "dave")]
+    assert [m["content"] for m in store.get_conversation("alice", "bob")][-2:] == ["note 3 pelican", "still here"]
+    assert store.conversation_message_count("alice", "bob") == 5
+    assert store.get_conversation("alice", "carol") == []
+    assert store.message_count() == 9
+    assert len(archived_segments(tmp_path)) == 1
+
+    # When every picked chat changed meanwhile, no segment is left behind
+    add_messages(store, "alice", "erin", 3, start=cold_start)
+
+    def clearing_write(name, conversations):
+        store.clear_conversation("alice", "erin")
+        return write(name, conversations)
+
+    store.archive.write = clearing_write
+    assert store.archive_cold(datetime.timedelta(days=90)) == 0
+    assert len(archived_segments(tmp_path)) == 1
+    assert open_test_store("json", tmp_path).message_count() == 9
+
+
+def test_json_archive_reads_match_hot_reads(tmp_path):
+    # Archived by hand below rather than by the snapshot thread at some point
+    store = open_test_store("json", tmp_path)
+    cold_start = datetime.datetime.now() - datetime.timedelta(days=200)
+    add_messages(store, "alice", "bob", 30, start=cold_start)
+    add_messages(store, "alice", "carol", 5)
+    store.add_message(make_message("bob", "dave", "pelican gossip", 0, cold_start))
+    before = store.get_conversation("alice", "bob")
+    hits = store.search_messages("alice", "pelican")
+    cursors = (None, hits[7]["id"], hits[29]["id"])
+    pages = [store.search_messages("alice", "pelican", limit=8, before=cursor) for cursor in cursors]
+
+    assert store.archive_cold(datetime.timedelta(days=90)) == 31
+    state = store.cache.get()
+    assert ("alice", "bob") in state["archived"] and ("alice", "bob") not in state["conversations"]
+    assert state["archived_keys"]["alice"] == [("alice", "bob")]
+    for reader in (store, open_test_store("json", tmp_path)):
+        assert reader.get_conversation("alice", "bob") == before
+        page = reader.get_conversation("alice", "bob", limit=10, before=message_cursor(before[-10]))
+        assert page == before[-20:-10]
+        assert reader.get_messages_since("alice", "bob", before[14]["id"]) == before[15:]
+        assert reader.search_messages("alice", "pelican") == hits
+        assert [reader.search_messages("alice", "pelican", limit=8, before=cursor) for cursor in cursors] == pages
+        assert reader.conversation_message_count("alice", "bob") == 30
+        assert reader.message_count() == 36
+
+    # Archived chats are searched through their postings; blocks are read only for hits on the page
+    reads = []
+    read = store.archive.read
+    store.archive.read = lambda name, key: reads.append(key) or read(name, key)
+    assert store.search_messages("alice", "pelican", limit=5) == hits[:5]
+    assert store.search_messages("alice", "albatross") == []
+    assert store.search_messages("alice", "note 12 pelican") == [m for m in hits if m["content"] == "note 12 pelican"]
+    assert reads == [("alice", "bob")]
+    assert [m["content"] for m in store.search_messages("dave", "gossip")] == ["pelican gossip"]
+
+    # New messages go to the hot state and read after the archived ones
+    new_id = store.add_message(make_message("bob", "alice", "back again", 0, datetime.datetime.now()))
+    assert store.get_conversation("alice", "bob")[-1]["id"] == new_id
+    assert store.conversation_message_count("alice", "bob") == 31
+
+    # A clear covers archived messages too
+    store.clear_conversation("alice", "bob")
+    assert store.get_conversation("alice", "bob") == []
+    assert store.get_messages_since("alice", "bob", 0) == []
+    assert store.search_messages("alice", "pelican", contact="bob") == []
+    assert store.message_count() == 6
@@ -1,11 +1,62 @@
 # whatsapp_fixed.py
 import streamlit as st
 import datetime
-import base64
-import io
-import json
+import html
 import os
-from PIL import Image
+import time
+from streamlit.errors import StreamlitAPIException
+from blobstore import BlobStore
+from chatlog import message_cursor
+from events import conversation_topic, user_topic
+from imaging import submit_image
+from perf import metrics
+from render_cache import FragmentCache
+from search import snippet
+from storage import open_store
+
+# Legacy full snapshot plus the append-only change log
+DATA_FILE = 'chat_data.json'
+LOG_FILE = 'chat_data.log'
+SQLITE_FILE = 'chat_data.sqlite3'
+
+# Image blobs live next to this script so Streamlit's static file serving can reach them
+BLOB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "blobs")
+
+# Display format of a message's "time"
+TIME_FORMAT = "%H:%M"
+
+# Storage backend: "json" (JSON file plus change log), "sqlite", or "sharded"
+# (users in the SQLite file, messages in shard files next to it)
+STORAGE_BACKEND = os.environ.get("CHAT_STORAGE", "json")
+
+# Days without messages after which the JSON backend moves a chat into the
+# compressed archive; CHAT_ARCHIVE_DAYS=0 keeps every chat in the hot state
+ARCHIVE_AFTER_DAYS = float(os.environ.get("CHAT_ARCHIVE_DAYS", "90"))
+
+# Number of messages shown per page of chat history
+HISTORY_PAGE_SIZE = 50
+
+# Number of hits shown per page of search results
+SEARCH_PAGE_SIZE = 10
+
+# Number of usernames suggested while typing a contact to add
+SUGGESTION_LIMIT = 5
+
+# Seconds between polls for new messages in the open chat
+LIVE_UPDATE_SECONDS = 2
+
+# Seconds between refreshes of the chat info panel, which no write reruns directly
+INFO_REFRESH_SECONDS = 10
+
+# Seconds after which a session re-queries even without change events,
+# to pick up writes made by other processes
+RESYNC_SECONDS = 30
+
+# Users who see the performance panel, e.g. CHAT_ADMINS="alice,bob"
+ADMIN_USERS = {name.strip() for name in os.environ.get("CHAT_ADMINS", "").split(",") if name.strip()}
+
+# File the performance panel appends metric snapshots to
+PERF_DUMP_FILE = "perf_metrics.jsonl"
 
 # Page configuration
 st.set_page_config(
@@ -14,39 +65,44 @@ st.set_page_config(
     layout="wide"
 ) 
 
-def load_chat_data():
-    """Load chat data from JSON file"""
-    try:
-        if os.path.exists('chat_data.json'):
-            with open('chat_data.json', 'r') as f:
-                return json.load(f)
-    except Exception as e:
-        st.error(f"Error loading chat data: {e}")
-    return {"messages": [], "users": {}}
+@st.cache_resource
+def get_store():
+    """Storage engine shared by all sessions"""
+    return open_store(
+        STORAGE_BACKEND, "contact", DATA_FILE, LOG_FILE, SQLITE_FILE, BlobStore(BLOB_DIR), TIME_FORMAT,
+        archive_after_days=ARCHIVE_AFTER_DAYS
+    )
 
-def save_chat_data():
-    """Save chat data to JSON file"""
+def save_chat_change(write, *args):
+    """Run a store write, reporting any failure in the UI; return the write's result"""
     try:
-        with open('chat_data.json', 'w') as f:
-            json.dump({
-                'messages': st.session_state.messages,
-                'users': st.session_state.users
-            }, f)
+        with metrics.span("store.write"):
+            return write(*args)
     except Exception as e:
         st.error(f"Error saving chat data: {e}")
+        return None
+
+def rerun_fragment():
+    """Rerun only the running fragment; during a full page run, rerun the page"""
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
 
 def init_session_state():
     """Initialize session state with user management"""
+    # Users and messages live in the shared store; sessions only keep small per-chat views
     if "initialized" not in st.session_state:
-        data = load_chat_data()
-        st.session_state.messages = data.get("messages", [])
-        st.session_state.users = data.get("users", {})
         st.session_state.current_user = None
         st.session_state.current_contact = None
         st.session_state.initialized = True
         st.session_state.uploaded_files = {}  # Track uploaded files
-
-init_session_state()
+        st.session_state.pending_images = []  # Uploads still being processed in the background
+        st.session_state.history_cursors = []  # (timestamp, id) cursor per "load older" step
+        st.session_state.chat_view = None  # Latest page of the open chat
+        st.session_state.contacts_view = None  # Contacts of the logged-in user
+        st.session_state.search_pages = {}  # Query and message id cursors per search box
+        st.session_state.highlight_id = None  # Message opened from a search result
 
 # Custom CSS
 st.markdown("""
@@ -84,10 +140,13 @@ st.markdown("""
         margin-bottom: 0.25rem;
         color: #128c7e;
     }
+    .chat-message.search-hit {
+        outline: 3px solid #f5c518;
+    }
 </style>
 """, unsafe_allow_html=True)
 
-def login_section():
+def login_section(store):
     """User login/registration section"""
     st.sidebar.header("🔐 Login / Register")
     
@@ -96,7 +155,7 @@ def login_section():
     with tab1:
         username = st.text_input("Username", key="login_username")
         if st.button("Login", key="login_btn"):
-            if username and username in st.session_state.users:
+            if username and store.get_user(username) is not None:
                 st.session_state.current_user = username
                 st.rerun()
             else:
@@ -106,43 +165,65 @@ def login_section():
         new_username = st.text_input("Choose Username", key="register_username")
         if st.button("Register", key="register_btn"):
             if new_username:
-                if new_username not in st.session_state.users:
-                    st.session_state.users[new_username] = {
-                        "created_at": datetime.datetime.now().isoformat(),
-                        "contacts": []
+                if store.get_user(new_username) is None:
+                    user = {
+                        "created_at": datetime.datetime.now().isoformat()
                     }
-                    st.session_state.current_user = new_username
-                    save_chat_data()
-                    st.rerun()
+                    if save_chat_change(store.add_user, new_username, user):
+                        st.session_state.current_user = new_username
+                        st.rerun()
                 else:
                     st.error("Username already exists!")
             else:
                 st.error("Please enter a username")
 
-def display_message(message):
-    """Display a single message in the chat"""
-    sender_display = "You" if message["sender"] == st.session_state.current_user else message["sender"]
-    
-    if message["type"] == "text":
-        st.markdown(f"""
-        <div class="chat-message {'user' if message['sender'] == st.session_state.current_user else 'contact'}">
-            <div style="flex-grow: 1;">
-                <div class="message-sender">{sender_display}</div>
-                <div>{message['content']}</div>
-                <div class="message-time">{message['time']}</div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-    elif message["type"] == "image":
-        st.markdown(f"""
-        <div class="chat-message {'user' if message['sender'] == st.session_state.current_user else 'contact'}">
-            <div style="flex-grow: 1;">
-                <div class="message-sender">{sender_display}</div>
-                <img src="{message['content']}" style="max-width: 300px; border-radius: 0.5rem;">
-                <div class="message-time">{message['time']}</div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+@st.cache_resource
+def get_render_cache():
+    """Rendered message HTML shared by all sessions"""
+    return FragmentCache()
+
+def render_message(message, is_current_user, highlighted=False):
+    """Build the escaped HTML for a single message in the chat"""
+    sender_display = "You" if is_current_user else html.escape(message["sender"])
+    if message["type"] == "image":
+        image_style = 'style="max-width: 300px; border-radius: 0.5rem;"'
+        full_src = html.escape(get_store().image_src(message["content"]))
+        if message.get("thumbnail"):
+            # Show the thumbnail inline; the full-size image only loads when opened
+            thumbnail_src = html.escape(get_store().image_src(message["thumbnail"]))
+            body = f'<a href="{full_src}" target="_blank"><img src="{thumbnail_src}" {image_style}></a>'
+        else:
+            body = f'<img src="{full_src}" {image_style}>'
+    else:
+        content = html.escape(message["content"]).replace("\n", "<br>")
+        body = f"<div>{content}</div>"
+    return (
+        f'<div class="chat-message {"user" if is_current_user else "contact"}{" search-hit" if highlighted else ""}">'
+        '<div style="flex-grow: 1;">'
+        f'<div class="message-sender">{sender_display}</div>'
+        f'{body}'
+        f'<div class="message-time">{html.escape(message["time"])}</div>'
+        '</div></div>'
+    )
+
+@metrics.timed("render.display_messages")
+def display_messages(messages):
+    """Display a page of chat messages as a single HTML block"""
+    cache = get_render_cache()
+    fragments = []
+    for message in messages:
+        if message["type"] not in ("text", "image"):
+            continue
+        is_current_user = message["sender"] == st.session_state.current_user
+        highlighted = message.get("id") == st.session_state.highlight_id
+        fragments.append(cache.get(
+            (message.get("id"), message["timestamp"], is_current_user, highlighted),
+            (message["type"], message["sender"], message["content"], message.get("thumbnail"), message["time"]),
+            render_message, message, is_current_user, highlighted
+        ))
+    metrics.count("render.messages", len(fragments))
+    if fragments:
+        st.markdown("".join(fragments), unsafe_allow_html=True)
 
 def add_text_message(content, sender, contact):
     """Add a text message to chat"""
@@ -150,162 +231,383 @@ def add_text_message(content, sender, contact):
         "type": "text",
         "sender": sender,
         "content": content,
-        "time": datetime.datetime.now().strftime("%H:%M"),
+        "time": datetime.datetime.now().strftime(TIME_FORMAT),
         "contact": contact,
         "timestamp": datetime.datetime.now().isoformat()
     }
-    st.session_state.messages.append(new_message)
-    save_chat_data()
+    save_chat_change(get_store().add_message, new_message)
 
-def add_image_message(image_data, sender, contact):
+def add_image_message(image_ref, thumbnail_ref, sender, contact):
     """Add an image message to chat - FIXED to prevent duplicates"""
     # Check if this image was already sent in the last 2 seconds
     recent_messages = [
-        msg for msg in st.session_state.messages[-5:] 
-        if msg.get("sender") == sender and msg.get("contact") == contact
+        msg for msg in get_store().get_conversation(sender, contact, limit=5)
+        if msg.get("sender") == sender
     ]
     
+    # Same bytes give the same blob id, so this is a cheap string comparison
     for msg in recent_messages:
-        if msg.get("content") == image_data:
+        if msg.get("content") == image_ref:
             # This image was already sent recently
             return
     
     new_message = {
         "type": "image",
         "sender": sender,
-        "content": image_data,
-        "time": datetime.datetime.now().strftime("%H:%M"),
+        "content": image_ref,
+        "thumbnail": thumbnail_ref,
+        "time": datetime.datetime.now().strftime(TIME_FORMAT),
         "contact": contact,
         "timestamp": datetime.datetime.now().isoformat()
     }
-    st.session_state.messages.append(new_message)
-    save_chat_data()
+    save_chat_change(get_store().add_message, new_message)
 
-def contacts_section():
+def collect_processed_images():
+    """Send the uploads whose background processing has finished"""
+    still_pending = []
+    for upload in st.session_state.pending_images:
+        if not upload["future"].done():
+            still_pending.append(upload)
+            continue
+        try:
+            image_ref, thumbnail_ref = upload["future"].result()
+        except Exception as e:
+            st.error(f"Could not process image: {e}")
+            continue
+        add_image_message(image_ref, thumbnail_ref, upload["sender"], upload["contact"])
+    st.session_state.pending_images = still_pending
+
+@st.fragment(run_every=1)
+def wait_for_images():
+    """Rerun the page once every pending upload has been processed"""
+    if all(upload["future"].done() for upload in st.session_state.pending_images):
+        st.rerun()
+
+def load_contacts(store, current_user):
+    """Return the user's contacts, re-reading them only after a change was published"""
+    view = st.session_state.contacts_view
+    if (view is None or view["user"] != current_user or view["events"].poll() or
+            time.monotonic() - view["synced"] > RESYNC_SECONDS):
+        view = {
+            "user": current_user,
+            # Subscribe before reading so no write between the two is missed
+            "events": store.events.subscribe(user_topic(current_user)),
+            "contacts": store.get_contacts(current_user),
+            "synced": time.monotonic()
+        }
+        st.session_state.contacts_view = view
+    return view["contacts"]
+
+def add_contact(store, current_user, new_contact):
+    """Add a user to the current user's contacts, reporting problems in the sidebar"""
+    if store.get_user(new_contact) is not None:
+        if new_contact not in load_contacts(store, current_user):
+            if save_chat_change(store.add_contact, current_user, new_contact):
+                st.success(f"Added {new_contact} to contacts!")
+                rerun_fragment()
+        else:
+            st.error("Contact already added!")
+    else:
+        st.error("User not found!")
+
+@st.fragment
+def contacts_fragment(store, current_user):
+    """Sidebar contacts; adding a contact reruns only this fragment"""
+    with metrics.rerun("fragment:contacts"):
+        contacts_section(store, current_user)
+
+def contacts_section(store, current_user):
     """Contacts management section"""
-    st.sidebar.header("👥 Contacts")
+    st.header("👥 Contacts")
     
     # Add contact
-    new_contact = st.sidebar.text_input("Add contact by username:")
-    if st.sidebar.button("Add Contact") and new_contact:
-        if new_contact in st.session_state.users:
-            if new_contact not in st.session_state.users[st.session_state.current_user]["contacts"]:
-                st.session_state.users[st.session_state.current_user]["contacts"].append(new_contact)
-                save_chat_data()
-                st.sidebar.success(f"Added {new_contact} to contacts!")
-                st.rerun()
-            else:
-                st.sidebar.error("Contact already added!")
-        else:
-            st.sidebar.error("User not found!")
+    new_contact = st.text_input("Add contact by username:")
+    if st.button("Add Contact") and new_contact:
+        add_contact(store, current_user, new_contact)
     
-    st.sidebar.markdown("---")
+    if new_contact:
+        # Autocomplete from the sorted user directory; only one short page is read
+        known = set(load_contacts(store, current_user))
+        for name in store.find_users(new_contact, limit=SUGGESTION_LIMIT):
+            if name != current_user and name not in known:
+                if st.button(f"➕ {name}", key=f"suggest_{name}"):
+                    add_contact(store, current_user, name)
+    
+    st.markdown("---")
     
     # Display contacts
-    current_user_contacts = st.session_state.users[st.session_state.current_user].get("contacts", [])
+    current_user_contacts = load_contacts(store, current_user)
     
     if not current_user_contacts:
-        st.sidebar.info("No contacts yet. Add someone to start chatting!")
+        st.info("No contacts yet. Add someone to start chatting!")
     else:
-        st.sidebar.subheader("Your Contacts:")
+        st.subheader("Your Contacts:")
         for contact in current_user_contacts:
-            if st.sidebar.button(f"💬 {contact}", key=f"chat_{contact}"):
+            if st.button(f"💬 {contact}", key=f"chat_{contact}"):
                 st.session_state.current_contact = contact
+                st.session_state.history_cursors = []
+                st.session_state.highlight_id = None
+                # Opening another chat changes the chat pane too
                 st.rerun()
 
-def chat_section():
-    """Main chat section"""
-    col1, col2 = st.columns([3, 1])
+def open_search_hit(message, contact):
+    """Open the chat holding a search hit at the page ending with it"""
+    st.session_state.current_contact = contact
+    timestamp, message_id = message_cursor(message)
+    # Cursors exclude the message they name, so point just past the hit
+    st.session_state.history_cursors = [(timestamp, message_id + 1)]
+    st.session_state.highlight_id = message["id"]
+
+def show_search_results(store, current_user, query, contact, key):
+    """Show one page of search hits, newest first; clicking a hit opens it in its chat"""
+    search = st.session_state.search_pages.get(key)
+    if search is None or search["query"] != query or search["contact"] != contact:
+        # A new query starts again from the newest hits
+        search = {"query": query, "contact": contact, "cursors": []}
+        st.session_state.search_pages[key] = search
+    cursors = search["cursors"]
+    
+    # One extra hit is fetched to know whether older results exist
+    hits = store.search_messages(
+        current_user, query, contact=contact,
+        limit=SEARCH_PAGE_SIZE + 1,
+        before=cursors[-1] if cursors else None
+    )
+    page = hits[:SEARCH_PAGE_SIZE]
+    if not page:
+        st.info("No matching messages.")
+        return
     
-    with col1:
-        if st.session_state.current_contact:
-            st.header(f"💬 Chat with {st.session_state.current_contact}")
-            
-            # Display messages for this chat
-            chat_container = st.container()
-            with chat_container:
-                # Get messages between current user and current contact
-                chat_messages = [
-                    m for m in st.session_state.messages 
-                    if ((m["sender"] == st.session_state.current_user and m["contact"] == st.session_state.current_contact) or
-                        (m["sender"] == st.session_state.current_contact and m["contact"] == st.session_state.current_user))
-                ]
-                
-                # Sort by timestamp
-                chat_messages.sort(key=lambda x: x.get("timestamp", ""))
-                
-                for message in chat_messages:
-                    display_message(message)
-            
-            # Input area
-            st.markdown("---")
-            
-            # Text input
-            text_input = st.chat_input(f"Type a message to {st.session_state.current_contact}...")
-            
-            if text_input:
-                add_text_message(text_input, st.session_state.current_user, st.session_state.current_contact)
+    for hit in page:
+        peer = hit["contact"] if hit["sender"] == current_user else hit["sender"]
+        label = f"{peer} · {hit['time']}: {snippet(hit['content'], query)}"
+        if st.button(label, key=f"search_{key}_{hit['id']}"):
+            open_search_hit(hit, peer)
+            # A hit in the open chat only moves the chat pane; any other opens a new chat
+            if contact:
+                rerun_fragment()
+            else:
                 st.rerun()
-            
-            # Image upload - FIXED to prevent multiple sends
-            st.subheader("📷 Share Image")
-            
-            # Use a unique key based on current contact to prevent re-upload issues
-            upload_key = f"image_upload_{st.session_state.current_contact}"
-            
-            uploaded_file = st.file_uploader(
-                "Choose an image", 
-                type=['png', 'jpg', 'jpeg'],
-                key=upload_key
-            )
-            
-            if uploaded_file is not None:
-                # Check if this is a new file upload
-                file_id = f"{st.session_state.current_user}_{st.session_state.current_contact}_{uploaded_file.name}"
-                
-                if file_id not in st.session_state.uploaded_files:
-                    # Convert uploaded file to base64
-                    image = Image.open(uploaded_file)
-                    buffered = io.BytesIO()
-                    image.save(buffered, format="PNG")
-                    img_str = base64.b64encode(buffered.getvalue()).decode()
-                    image_data = f"data:image/png;base64,{img_str}"
-                    
-                    add_image_message(image_data, st.session_state.current_user, st.session_state.current_contact)
-                    st.session_state.uploaded_files[file_id] = True
-                    st.rerun()
-        
+    
+    col1, col2 = st.columns(2)
+    if cursors and col1.button("⬅️ Newer", key=f"search_{key}_newer"):
+        cursors.pop()
+        rerun_fragment()
+    if len(hits) > SEARCH_PAGE_SIZE and col2.button("Older ➡️", key=f"search_{key}_older"):
+        cursors.append(page[-1]["id"])
+        rerun_fragment()
+
+@st.fragment
+def search_fragment(store, current_user):
+    """Sidebar search; paging through hits reruns only this fragment"""
+    with metrics.rerun("fragment:search"):
+        search_section(store, current_user)
+
+def search_section(store, current_user):
+    """Search across all of the user's chats"""
+    st.header("🔎 Search Messages")
+    
+    query = st.text_input("Search all chats:", key="global_search").strip()
+    if query:
+        show_search_results(store, current_user, query, None, "global")
+
+def load_chat_view(store, current_user, current_contact):
+    """Return the latest page of a chat, fetching only messages newer than the view's cursor"""
+    view = st.session_state.chat_view
+    # Re-read the page when a chat opens, and now and then for clears and other processes
+    if (view is None or view["chat"] != (current_user, current_contact) or
+            time.monotonic() - view["synced"] > RESYNC_SECONDS):
+        # Subscribe before reading so no write between the two is missed
+        events = store.events.subscribe(conversation_topic(current_user, current_contact))
+        # One extra message is fetched to know whether older history exists
+        page = store.get_conversation(current_user, current_contact, limit=HISTORY_PAGE_SIZE + 1)
+        view = {
+            "chat": (current_user, current_contact),
+            "events": events,
+            "page": page,
+            "cursor": max((msg["id"] for msg in page), default=0),
+            "synced": time.monotonic()
+        }
+        st.session_state.chat_view = view
+    elif view["events"].poll():
+        new_messages = store.get_messages_since(current_user, current_contact, view["cursor"])
+        if new_messages:
+            view["cursor"] = new_messages[-1]["id"]
+            view["page"].extend(new_messages)
+            # Keep the window plus the extra message that shows older history exists
+            del view["page"][:-(HISTORY_PAGE_SIZE + 1)]
+    return view["page"]
+
+def show_older_button(page):
+    """Offer older history when the page holds the extra message showing it exists"""
+    # The page is already sorted by timestamp
+    if len(page) > HISTORY_PAGE_SIZE and st.button("⬆️ Load older messages", key="history_older"):
+        st.session_state.history_cursors.append(message_cursor(page[-HISTORY_PAGE_SIZE]))
+        rerun_fragment()
+
+def show_chat_page(page):
+    """Display one page of older history with its navigation"""
+    show_older_button(page)
+    display_messages(page[-HISTORY_PAGE_SIZE:])
+    
+    if st.button("⬇️ Show newer messages", key="history_newer"):
+        st.session_state.history_cursors.pop()
+        st.session_state.highlight_id = None
+        rerun_fragment()
+
+@st.fragment(run_every=LIVE_UPDATE_SECONDS)
+def live_chat(current_user, current_contact):
+    """Show the latest page, fetching only the messages that arrived since the last poll"""
+    with metrics.rerun("fragment:live_chat"):
+        poll_live_chat(current_user, current_contact)
+
+def poll_live_chat(current_user, current_contact):
+    """Show the latest page of the open chat from the session's view"""
+    display_messages(load_chat_view(get_store(), current_user, current_contact)[-HISTORY_PAGE_SIZE:])
+
+@st.fragment
+def chat_fragment(store, current_user, current_contact):
+    """Chat pane; sending and paging rerun only this fragment"""
+    with metrics.rerun("fragment:chat"):
+        chat_section(store, current_user, current_contact)
+
+def chat_section(store, current_user, current_contact):
+    """Main chat section"""
+    if not current_contact:
+        st.info("👈 Select a contact to start chatting!")
+        return
+    
+    st.header(f"💬 Chat with {current_contact}")
+    
+    # Search within this chat
+    chat_query = st.text_input(
+        "🔎 Search this chat",
+        key=f"chat_search_{current_contact}"
+    ).strip()
+    if chat_query:
+        show_search_results(store, current_user, chat_query, current_contact, "chat")
+    
+    collect_processed_images()
+    
+    # Display messages for this chat
+    chat_container = st.container()
+    with chat_container:
+        cursors = st.session_state.history_cursors
+        if cursors:
+            show_chat_page(store.get_conversation(
+                current_user,
+                current_contact,
+                limit=HISTORY_PAGE_SIZE + 1,
+                before=cursors[-1]
+            ))
         else:
-            st.info("👈 Select a contact to start chatting!")
+            # Live mode: only the message list reruns on a timer, so the history button lives out here
+            show_older_button(load_chat_view(store, current_user, current_contact))
+            live_chat(current_user, current_contact)
+        
+        # Placeholders for this chat's uploads that are still being processed
+        for upload in st.session_state.pending_images:
+            if upload["contact"] == current_contact:
+                st.markdown(
+                    '<div class="chat-message user"><div style="flex-grow: 1;">'
+                    '<div class="message-sender">You</div><div>⏳ Processing image...</div>'
+                    '</div></div>',
+                    unsafe_allow_html=True
+                )
+        if st.session_state.pending_images:
+            wait_for_images()
     
-    with col2:
-        st.header("ℹ️ Chat Info")
-        if st.session_state.current_contact:
-            # Count messages in this chat
-            chat_message_count = len([
-                m for m in st.session_state.messages 
-                if ((m["sender"] == st.session_state.current_user and m["contact"] == st.session_state.current_contact) or
-                    (m["sender"] == st.session_state.current_contact and m["contact"] == st.session_state.current_user))
-            ])
-            
-            st.success(f"**Chat with:** {st.session_state.current_contact}")
-            st.info(f"**Messages:** {chat_message_count}")
-            
-            if st.button("Clear Chat History", type="secondary"):
-                # Remove messages from this chat
-                st.session_state.messages = [
-                    m for m in st.session_state.messages 
-                    if not ((m["sender"] == st.session_state.current_user and m["contact"] == st.session_state.current_contact) or
-                           (m["sender"] == st.session_state.current_contact and m["contact"] == st.session_state.current_user))
-                ]
-                save_chat_data()
-                st.rerun()
+    # Input area
+    st.markdown("---")
+    
+    # Text input
+    text_input = st.chat_input(f"Type a message to {current_contact}...")
+    
+    if text_input:
+        add_text_message(text_input, current_user, current_contact)
+        st.session_state.history_cursors = []
+        rerun_fragment()
+    
+    # Image upload - FIXED to prevent multiple sends
+    st.subheader("📷 Share Image")
+    
+    # Use a unique key based on current contact to prevent re-upload issues
+    upload_key = f"image_upload_{current_contact}"
+    
+    uploaded_file = st.file_uploader(
+        "Choose an image", 
+        type=['png', 'jpg', 'jpeg'],
+        key=upload_key
+    )
+    
+    if uploaded_file is not None:
+        # Check if this is a new file upload
+        file_id = f"{current_user}_{current_contact}_{uploaded_file.name}"
+        
+        if file_id not in st.session_state.uploaded_files:
+            # Resize and thumbnail in the background; the chat shows a placeholder meanwhile
+            st.session_state.pending_images.append({
+                "future": submit_image(uploaded_file.getvalue(), store.blobs),
+                "sender": current_user,
+                "contact": current_contact
+            })
+            st.session_state.uploaded_files[file_id] = True
+            rerun_fragment()
+
+@st.fragment(run_every=INFO_REFRESH_SECONDS)
+def info_fragment(store, current_user, current_contact):
+    """Chat info panel; refreshes on its own without rerunning the chat"""
+    with metrics.rerun("fragment:info"):
+        info_section(store, current_user, current_contact)
+
+def info_section(store, current_user, current_contact):
+    """Chat info section"""
+    st.header("ℹ️ Chat Info")
+    if current_contact:
+        # Count messages in this chat from the store's maintained counter
+        chat_message_count = store.conversation_message_count(current_user, current_contact)
+        
+        st.success(f"**Chat with:** {current_contact}")
+        st.info(f"**Messages:** {chat_message_count}")
+        
+        if st.button("Clear Chat History", type="secondary"):
+            # The store records a tombstone and compacts later
+            save_chat_change(store.clear_conversation, current_user, current_contact)
+            # The chat pane has to drop the cleared messages too
+            st.session_state.chat_view = None
+            st.rerun()
+
+def perf_panel():
+    """Admin-only panel with hot-path latency percentiles and counters"""
+    with st.sidebar.expander("⏱️ Performance"):
+        report = metrics.report()
+        st.caption("Spans in ms; `rerun:<counter>` rows are per-rerun totals")
+        st.dataframe(report["histograms"], hide_index=True)
+        st.dataframe(report["counters"], hide_index=True)
+        col1, col2 = st.columns(2)
+        if col1.button("💾 Dump", key="perf_dump"):
+            try:
+                metrics.dump(PERF_DUMP_FILE)
+                st.success(f"Saved to {PERF_DUMP_FILE}")
+            except Exception as e:
+                st.error(f"Error saving metrics: {e}")
+        if col2.button("🔄 Reset", key="perf_reset"):
+            metrics.reset()
+            st.rerun()
 
 def main():
+    init_session_state()
     st.title("💬 WhatsApp Clone - Multi User")
     
+    # Storage engine shared by every session; each section reads what it needs
+    try:
+        store = get_store()
+    except Exception as e:
+        st.error(f"Error loading chat data: {e}")
+        return
+    
     if not st.session_state.current_user:
-        login_section()
+        login_section(store)
         st.info("🔐 Please login or register to start chatting")
     else:
         st.sidebar.success(f"Logged in as: **{st.session_state.current_user}**")
@@ -315,8 +617,22 @@ def main():
             st.session_state.current_contact = None
             st.rerun()
         
-        contacts_section()
-        chat_section()
+        # Each part reruns on its own: a send redraws only the chat pane,
+        # a contact change only the contacts in the sidebar
+        current_user = st.session_state.current_user
+        current_contact = st.session_state.current_contact
+        # Fragments write to the sidebar from inside its context, not through st.sidebar
+        with st.sidebar:
+            contacts_fragment(store, current_user)
+            search_fragment(store, current_user)
+        if current_user in ADMIN_USERS:
+            perf_panel()
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            chat_fragment(store, current_user, current_contact)
+        with col2:
+            info_fragment(store, current_user, current_contact)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    with metrics.rerun():
+        main()
\ No newline at end of file
@@ -0,0 +1,69 @@
+# writer.py
+"""Group-commit writer shared by every session in the process.
+
+Writes from all sessions go onto one queue. A single background thread
+drains whatever has accumulated and persists it as one batch with a single
+fsync. While one batch is being synced the next one fills up, so throughput
+grows with the batch size instead of paying one sync per message.
+"""
+import queue
+import threading
+from concurrent.futures import Future
+
+from perf import metrics
+
+# Upper bound on items persisted together in one group commit
+MAX_BATCH = 512
+
+
+class GroupCommitWriter:
+    """Background thread persisting queued items in batches.
+
+    ``flush(items)`` must durably persist the items and return one result
+    per item. ``submit()`` returns a future resolved with that result once
+    the batch holding the item has been committed.
+    """
+
+    def __init__(self, flush, name="group-commit", max_batch=MAX_BATCH):
+        self.flush = flush
+        self.name = name
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """Queue an item for the next group commit"""
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def write(self, item):
+        """Queue an item and wait until it has been committed"""
+        return self.submit(item).result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        metrics.observe(f"{self.name}:batch_size", len(batch))
+        try:
+            with metrics.span(f"{self.name}:flush"):
+                results = self.flush([item for item, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                # Retry one by one so a bad item only fails its own sender
+                for entry in batch:
+                    self._commit([entry])
+            else:
+                batch[0][1].set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)